@@ -0,0 +1,105 @@
+import struct
+import timeit
+
+from dubbo import hessian2
+from dubbo import protocol
+from dubbo import serialization
+from dubbo._model import Object
+
+
+# the header codec before protocol.HEADER, kept here to compare against
+
+def legacyHeader(request, dataLength):
+    header = b''
+    header += protocol.MAGIC_NUMBER
+    flag = protocol.HESSIAN2_CONTENT_TYPE_ID | protocol.FLAG_REQUEST | protocol.FLAG_TWOWAY
+    header += flag.to_bytes(1, 'big')
+    header += b'\x00'
+    header += struct.pack('>q', request.rid)
+    header += struct.pack('>i', dataLength)
+    return header
+
+
+def legacyEncode(request):
+    data = protocol.encodeRequestData(request.data)
+    return legacyHeader(request, len(data)) + data
+
+
+def legacyDecode(frame):
+    header = frame[:protocol.HEADER_LENGTH]
+    flag = header[2]
+    status = header[3]
+    rid = struct.unpack('>q', header[4:12])[0]
+    dataLength = struct.unpack('>i', header[12:])[0]
+    return flag, status, rid, dataLength
+
+
+def newHeader(request, dataLength):
+    return protocol.HEADER.pack(protocol.MAGIC_NUMBER,
+                                protocol.HESSIAN2_CONTENT_TYPE_ID | protocol.FLAG_REQUEST | protocol.FLAG_TWOWAY,
+                                0, request.rid, dataLength)
+
+
+def newDecode(frame):
+    return protocol.decodeHeader(frame)
+
+
+def run(name, func, number):
+    elapsed = min(timeit.repeat(func, number=number, repeat=5))
+    print('%-28s %8.3f us/frame' % (name, elapsed / number * 1e6))
+
+
+if __name__ == '__main__':
+    invocation = protocol.RpcInvocation('queryStoreAllInfoById', 'Ljava/lang/Long;', [41], {
+        'path': 'com.dmall.oop.StoreService', 'interface': 'com.dmall.oop.StoreService',
+        'version': '1.0.0', 'timeout': 1000,
+    })
+    request = protocol.DubboRequest(data=invocation)
+    frame = protocol.encodeRequest(request)
+    assert legacyEncode(request) == frame
+    assert legacyDecode(frame) == newDecode(frame)[1:]
+    assert newHeader(request, len(frame) - protocol.HEADER_LENGTH) == frame[:protocol.HEADER_LENGTH]
+
+    number = 200000
+    run('header encode, legacy', lambda: legacyHeader(request, 100), number)
+    run('header encode, Struct', lambda: newHeader(request, 100), number)
+    run('header decode, legacy', lambda: legacyDecode(frame), number)
+    run('header decode, Struct', lambda: newDecode(frame), number)
+
+    number = 50000
+    run('request encode, legacy', lambda: legacyEncode(request), number)
+    run('request encode, Struct', lambda: protocol.encodeRequest(request), number)
+
+    def split():
+        decoder = protocol.FrameDecoder()
+        decoder.feed(stream)
+        for header, body in decoder.frames():
+            pass
+
+    stream = frame * 100
+    elapsed = min(timeit.repeat(split, number=500, repeat=5))
+    print('%-28s %8.3f us/frame' % ('FrameDecoder', elapsed / 500 / 100 * 1e6))
+
+    # the same call with an object argument and result in each serialization
+    query = Object('com.dmall.oop.StoreQuery', {'storeId': 41, 'venderId': 1, 'name': 'store', 'tags': ['a', 'b', 'c']})
+    store = Object('com.dmall.oop.Store', {'id': 41, 'name': 'store', 'address': 'road 1', 'open': True,
+                                           'scores': [1.5, 2.5], 'owner': {'id': 1, 'name': 'owner'}})
+    for name in sorted(serialization.SERIALIZATIONS):
+        attachments = dict(invocation.attachments, serialization=name)
+        request = protocol.DubboRequest(data=protocol.RpcInvocation('query', 'Lcom/dmall/oop/StoreQuery;', [query], attachments))
+        response = protocol.DubboResponse(request.rid)
+        response.serialization = name
+        response.result = protocol.RpcResult(store)
+        frame = protocol.encodeResponse(response)
+        header = protocol.decodeHeader(frame)
+        run('%s request encode' % name, lambda: protocol.encodeRequest(request), number)
+        run('%s response decode' % name, lambda: protocol.decode(header, frame[protocol.HEADER_LENGTH:]), number)
+
+    # a List<Store> result, classdefs are sent once and the instances are read with 0x60 refs
+    output = hessian2.Hessian2Output()
+    output.writeObject([Object('com.dmall.oop.Store', {'id': i, 'name': 'store %d' % i, 'address': 'road 1', 'open': True,
+                                                       'scores': [1.5, 2.5], 'owner': {'id': 1, 'name': 'owner'}})
+                        for i in range(1000)])
+    body = output.getByteString()
+    elapsed = min(timeit.repeat(lambda: hessian2.Hessian2Input(body).readObject(), number=20, repeat=5))
+    print('%-28s %8.3f us/object' % ('hessian2 list decode', elapsed / 20 / 1000 * 1e6))
@@ -1,6 +1,7 @@
 #
 
 from .dubbo import Dubbo
+from .sync import SyncDubbo
 from ._utils import formatObject
 
 from ._model import Object
@@ -0,0 +1,106 @@
+import asyncio
+
+from ._cache import _freeze
+from .constants import *
+
+
+class Batcher(object):
+    '''
+        merges the single key calls of one method made within window seconds, or
+        up to maxSize keys, into one call of a method taking the list of keys.
+        the result is matched back to the keys: a dict by its keys, a list by the
+        key function applied to each element, or by position without one.
+        a key with no element in the result gets None
+    '''
+    def __init__(self, name, load, window=DEFAULT_BATCH_WINDOW, maxSize=DEFAULT_BATCH_MAX_SIZE, key=None):
+        self.name = name
+        # coroutine function called with the list of keys
+        self.load = load
+        self.window = window
+        self.maxSize = maxSize
+        self.key = key
+        # frozen key -> (key, [futures of its callers])
+        self.pending = {}
+        self.handle = None
+        # batch calls sent and not answered yet
+        self.dispatching = set()
+
+        self.calls = 0
+        self.batches = 0
+        self.keys = 0
+        self.maxBatch = 0
+
+    async def get(self, key):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.calls += 1
+        frozen = _freeze(key)
+        if frozen in self.pending:
+            # the same key twice in a window is sent once
+            self.pending[frozen][1].append(future)
+        else:
+            self.pending[frozen] = (key, [future])
+        if len(self.pending) >= self.maxSize:
+            self.__flush()
+        elif self.handle is None:
+            if self.window:
+                self.handle = loop.call_later(self.window, self.__flush)
+            else:
+                self.handle = loop.call_soon(self.__flush)
+        return (await future)
+
+    async def drain(self):
+        '''
+            sends the open window now and waits for the batch calls in flight
+        '''
+        self.__flush()
+        if self.dispatching:
+            await asyncio.wait(list(self.dispatching))
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'batches': self.batches,
+            'keys': self.keys,
+            'maxBatch': self.maxBatch,
+        }
+
+    def __flush(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        batch, self.pending = self.pending, {}
+        if batch:
+            self.batches += 1
+            self.keys += len(batch)
+            self.maxBatch = max(self.maxBatch, len(batch))
+            task = asyncio.ensure_future(self.__dispatch(batch))
+            self.dispatching.add(task)
+            task.add_done_callback(self.dispatching.discard)
+
+    async def __dispatch(self, batch):
+        keys = [key for key, futures in batch.values()]
+        try:
+            result = await self.load(keys)
+            if isinstance(result, dict):
+                values = dict((_freeze(k), v) for k, v in result.items())
+            elif self.key is not None:
+                values = dict((_freeze(self.key(item)), item) for item in result or [] if item is not None)
+            else:
+                values = dict((_freeze(k), v) for k, v in zip(keys, result or []))
+        except asyncio.CancelledError:
+            for key, futures in batch.values():
+                for future in futures:
+                    future.cancel()
+            raise
+        except Exception as e:
+            for key, futures in batch.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+        for frozen, (key, futures) in batch.items():
+            value = values.get(frozen)
+            for future in futures:
+                if not future.done():
+                    future.set_result(value)
@@ -0,0 +1,166 @@
+import time
+
+from .constants import *
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'halfOpen'
+
+
+class RollingWindow(object):
+    '''
+        request, error and slow call counts of the last windowSize seconds, kept in buckets
+    '''
+    def __init__(self, windowSize=DEFAULT_BREAKER_WINDOW, buckets=DEFAULT_BREAKER_BUCKETS):
+        self.bucketWidth = float(windowSize) / buckets
+        self.buckets = [[0, 0, 0, 0.0] for i in range(buckets)]
+        self.stamps = [-1] * buckets
+
+    def record(self, ok, slow, latency):
+        bucket = self.__bucket(time.monotonic())
+        bucket[0] += 1
+        if not ok:
+            bucket[1] += 1
+        if slow:
+            bucket[2] += 1
+        bucket[3] += latency
+
+    def totals(self):
+        now = int(time.monotonic() / self.bucketWidth)
+        requests = errors = slow = 0
+        latency = 0.0
+        for stamp, bucket in zip(self.stamps, self.buckets):
+            if now - stamp < len(self.buckets):
+                requests += bucket[0]
+                errors += bucket[1]
+                slow += bucket[2]
+                latency += bucket[3]
+        return requests, errors, slow, latency
+
+    def reset(self):
+        self.stamps = [-1] * len(self.buckets)
+
+    def __bucket(self, now):
+        stamp = int(now / self.bucketWidth)
+        index = stamp % len(self.buckets)
+        if self.stamps[index] != stamp:
+            self.stamps[index] = stamp
+            self.buckets[index] = [0, 0, 0, 0.0]
+        return self.buckets[index]
+
+
+class CircuitBreaker(object):
+    '''
+        health of one provider channel. the channel is ejected when its error
+        or slow call rate over the rolling window crosses a threshold, or after
+        consecutiveErrors failures in a row. once the ejection time is over a
+        few half-open probes decide whether it is let back in. the ejection
+        time doubles with every ejection in a row, up to maxEjectionTime
+    '''
+    def __init__(self, name, windowSize=DEFAULT_BREAKER_WINDOW, minRequests=DEFAULT_BREAKER_MIN_REQUESTS,
+                 errorThreshold=DEFAULT_BREAKER_ERROR_THRESHOLD, slowThreshold=0,
+                 slowCallDuration=DEFAULT_BREAKER_SLOW_CALL_DURATION,
+                 consecutiveErrors=DEFAULT_BREAKER_CONSECUTIVE_ERRORS,
+                 baseEjectionTime=DEFAULT_BREAKER_BASE_EJECTION_TIME,
+                 maxEjectionTime=DEFAULT_BREAKER_MAX_EJECTION_TIME, halfOpenProbes=DEFAULT_BREAKER_HALF_OPEN_PROBES):
+        self.name = name
+        self.window = RollingWindow(windowSize)
+        self.minRequests = minRequests
+        self.errorThreshold = errorThreshold
+        self.slowThreshold = slowThreshold
+        self.slowCallDuration = slowCallDuration
+        self.consecutiveErrors = consecutiveErrors
+        self.baseEjectionTime = baseEjectionTime
+        self.maxEjectionTime = maxEjectionTime
+        self.halfOpenProbes = halfOpenProbes
+
+        self.state = STATE_CLOSED
+        self.errorsInRow = 0
+        self.ejectedAt = 0.0
+        self.ejectionTime = 0.0
+        self.ejectionsInRow = 0
+        self.probes = 0
+        self.probeSuccesses = 0
+        self.ejections = 0
+
+    def available(self):
+        if self.state == STATE_OPEN:
+            if time.monotonic() - self.ejectedAt < self.ejectionTime:
+                return False
+            self.state = STATE_HALF_OPEN
+            self.probes = 0
+            self.probeSuccesses = 0
+        if self.state == STATE_HALF_OPEN:
+            return self.probes < self.halfOpenProbes
+        return True
+
+    def onStart(self):
+        '''
+            returns whether the request is a half-open probe, to be passed back to record
+        '''
+        if self.state == STATE_HALF_OPEN:
+            self.probes += 1
+            return True
+        return False
+
+    def record(self, ok, latency, probe=False):
+        slow = bool(self.slowThreshold) and latency >= self.slowCallDuration
+        self.window.record(ok, slow, latency)
+        self.errorsInRow = 0 if ok else self.errorsInRow + 1
+
+        if probe:
+            self.probes -= 1
+            if self.state != STATE_HALF_OPEN:
+                return
+            if not ok or slow:
+                self.__eject('half-open probe failed')
+                return
+            self.probeSuccesses += 1
+            if self.probeSuccesses >= self.halfOpenProbes:
+                self.state = STATE_CLOSED
+                self.ejectionsInRow = 0
+                self.window.reset()
+                print('Provider %s is back after half-open probes' % self.name)
+            return
+
+        if self.state != STATE_CLOSED:
+            # started before the ejection, or not a probe
+            return
+        if self.consecutiveErrors and self.errorsInRow >= self.consecutiveErrors:
+            self.__eject('%d errors in a row' % self.errorsInRow)
+            return
+        requests, errors, slowCalls, total = self.window.totals()
+        if requests < self.minRequests:
+            return
+        if errors >= requests * self.errorThreshold:
+            self.__eject('error rate %.2f' % (float(errors) / requests))
+        elif self.slowThreshold and slowCalls >= requests * self.slowThreshold:
+            self.__eject('slow call rate %.2f' % (float(slowCalls) / requests))
+
+    def skip(self, probe=False):
+        '''
+            the request never reached the provider
+        '''
+        if probe:
+            self.probes -= 1
+
+    def stats(self):
+        requests, errors, slowCalls, latency = self.window.totals()
+        return {
+            'state': self.state,
+            'requests': requests,
+            'errors': errors,
+            'slowCalls': slowCalls,
+            'averageLatency': latency / requests if requests else 0.0,
+            'ejections': self.ejections,
+            'ejectionTime': self.ejectionTime,
+        }
+
+    def __eject(self, reason):
+        self.ejectionTime = min(self.baseEjectionTime * (2 ** self.ejectionsInRow), self.maxEjectionTime)
+        self.ejectionsInRow += 1
+        self.ejections += 1
+        self.ejectedAt = time.monotonic()
+        self.state = STATE_OPEN
+        self.errorsInRow = 0
+        print('Provider %s ejected for %ss, %s' % (self.name, self.ejectionTime, reason))
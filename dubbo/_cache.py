@@ -0,0 +1,152 @@
+import asyncio
+import collections
+import sys
+import time
+
+from . import _model
+from .constants import *
+
+
+class ResultCache(object):
+    '''
+        results of one method keyed by its arguments, evicted least recently used
+        past maxEntries or maxSize bytes. an expired entry is still returned for
+        stale more seconds while it is loaded again in the background. concurrent
+        misses of the same arguments share one call
+    '''
+    def __init__(self, name, ttl=DEFAULT_CACHE_TTL, maxEntries=DEFAULT_CACHE_MAX_ENTRIES, maxSize=0, stale=0):
+        self.name = name
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        # 0 means no limit, sizes are estimated
+        self.maxSize = maxSize
+        self.stale = stale
+        # key -> [value, expiresAt, size]
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.loading = {}
+
+        self.hits = 0
+        self.staleHits = 0
+        self.misses = 0
+        self.shared = 0
+        self.loads = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    async def get(self, args, load):
+        '''
+            the cached result for args, or the result of the coroutine load() returns
+        '''
+        key = _freeze(args)
+        entry = self.entries.get(key)
+        if entry is not None:
+            now = time.monotonic()
+            if now < entry[1]:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return entry[0]
+            if now < entry[1] + self.stale:
+                self.staleHits += 1
+                self.entries.move_to_end(key)
+                if key not in self.loading:
+                    self.__load(key, load)
+                return entry[0]
+            self.expirations += 1
+            self.__remove(key)
+
+        self.misses += 1
+        future = self.loading.get(key)
+        if future is None:
+            future = self.__load(key, load)
+        else:
+            self.shared += 1
+        # one caller giving up must not cancel the call for the others
+        return (await asyncio.shield(future))
+
+    async def drain(self):
+        '''
+            waits for the loads in progress, stale reloads among them
+        '''
+        if self.loading:
+            await asyncio.wait(list(self.loading.values()))
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'size': self.size,
+            'hits': self.hits,
+            'staleHits': self.staleHits,
+            'misses': self.misses,
+            'shared': self.shared,
+            'loads': self.loads,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+    def __load(self, key, load):
+        self.loads += 1
+        future = asyncio.ensure_future(self.__fill(key, load))
+        future.add_done_callback(_consume)
+        self.loading[key] = future
+        return future
+
+    async def __fill(self, key, load):
+        try:
+            value = await load()
+        finally:
+            self.loading.pop(key, None)
+        self.__put(key, value)
+        return value
+
+    def __put(self, key, value):
+        size = _sizeOf(value) if self.maxSize else 0
+        if self.maxSize and size > self.maxSize:
+            return
+        if key in self.entries:
+            self.__remove(key)
+        self.entries[key] = [value, time.monotonic() + self.ttl, size]
+        self.size += size
+        while len(self.entries) > self.maxEntries or (self.maxSize and self.size > self.maxSize):
+            self.__remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def __remove(self, key):
+        self.size -= self.entries.pop(key)[2]
+
+
+def _consume(future):
+    # a failed load nobody waits for any more must not be logged as never retrieved
+    if not future.cancelled():
+        future.exception()
+
+
+def _freeze(value):
+    if isinstance(value, _model.Object):
+        return (value._metaType,) + tuple(sorted((k, _freeze(v)) for k, v in value.__dict__.items() if k != '_metaType'))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        return ('{}',) + tuple(sorted((_freeze(k), _freeze(v)) for k, v in value.items()))
+    if isinstance(value, _model.Binary):
+        return ('Binary', value.value)
+    try:
+        hash(value)
+    except TypeError:
+        return repr(value)
+    return value
+
+
+def _sizeOf(value):
+    size = sys.getsizeof(value)
+    if isinstance(value, _model.Object):
+        value = value.__dict__
+    if isinstance(value, dict):
+        size += sum(_sizeOf(k) + _sizeOf(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set)):
+        size += sum(_sizeOf(v) for v in value)
+    return size
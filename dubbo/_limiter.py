@@ -0,0 +1,211 @@
+import asyncio
+import collections
+
+from .constants import *
+from .protocol import DubboRejectedException
+
+
+class ConcurrencyLimiter(object):
+    '''
+        caps the requests in flight, callers over the limit wait in a bounded
+        FIFO queue and are rejected when it is full or they waited too long.
+        limit 0 means unlimited, the limit may be changed at runtime
+    '''
+    def __init__(self, name, limit=0, queueSize=DEFAULT_LIMIT_QUEUE_SIZE, queueTimeout=DEFAULT_LIMIT_QUEUE_TIMEOUT):
+        self.name = name
+        self._limit = limit
+        self.queueSize = queueSize
+        self.queueTimeout = queueTimeout
+        self.active = 0
+        self.waiters = collections.deque()
+
+        self.acquired = 0
+        self.queued = 0
+        self.maxQueueDepth = 0
+        self.rejected = 0
+        self.queueTimeouts = 0
+
+    @property
+    def limit(self):
+        return self._limit
+
+    @limit.setter
+    def limit(self, value):
+        self._limit = value
+        self.__wakeWaiters()
+
+    async def acquire(self):
+        if not self._limit or (self.active < self._limit and not self.waiters):
+            self.active += 1
+            self.acquired += 1
+            return
+
+        if len(self.waiters) >= self.queueSize:
+            self.rejected += 1
+            raise DubboRejectedException('%s reach the limit of %s requests in flight and %s queued'
+                                         % (self.name, self._limit, len(self.waiters)))
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        self.queued += 1
+        self.maxQueueDepth = max(self.maxQueueDepth, len(self.waiters))
+        try:
+            if self.queueTimeout:
+                await asyncio.wait_for(waiter, self.queueTimeout)
+            else:
+                await waiter
+        except asyncio.TimeoutError:
+            self.queueTimeouts += 1
+            self.rejected += 1
+            raise DubboRejectedException('%s queue timeout, waited %ss' % (self.name, self.queueTimeout))
+        except BaseException:
+            # the slot was handed to us just before we gave up on it
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if not waiter.done():
+                waiter.cancel()
+
+    def release(self):
+        self.active -= 1
+        self.__wakeWaiters()
+
+    def stats(self):
+        return {
+            'limit': self._limit,
+            'active': self.active,
+            'queueDepth': len(self.waiters),
+            'maxQueueDepth': self.maxQueueDepth,
+            'acquired': self.acquired,
+            'queued': self.queued,
+            'rejected': self.rejected,
+            'queueTimeouts': self.queueTimeouts,
+        }
+
+    def __wakeWaiters(self):
+        while self.waiters and (not self._limit or self.active < self._limit):
+            waiter = self.waiters.popleft()
+            if waiter.done():
+                continue
+            self.active += 1
+            self.acquired += 1
+            waiter.set_result(None)
+
+
+class AdaptiveLimit(object):
+    '''
+        base of the limits adjusted at runtime. samples are collected into
+        windows of about one limit worth of requests, roughly one round trip,
+        and the limit is adjusted once per window
+    '''
+    def __init__(self, initialLimit=DEFAULT_ADAPTIVE_INITIAL_LIMIT, minLimit=DEFAULT_ADAPTIVE_MIN_LIMIT,
+                 maxLimit=DEFAULT_ADAPTIVE_MAX_LIMIT):
+        self.estimate = float(initialLimit)
+        self.minLimit = minLimit
+        self.maxLimit = maxLimit
+        self.__resetWindow()
+
+    @property
+    def limit(self):
+        return int(self.estimate)
+
+    def update(self, rtt, inflight, dropped):
+        self.windowSamples += 1
+        self.windowRtt += rtt
+        self.windowInflight = max(self.windowInflight, inflight)
+        self.windowDropped = self.windowDropped or dropped
+        self.sample(rtt)
+        if self.windowSamples >= max(self.limit, DEFAULT_ADAPTIVE_MIN_WINDOW):
+            estimate = self.adjust(self.windowRtt / self.windowSamples, self.windowInflight, self.windowDropped)
+            self.estimate = max(self.minLimit, min(self.maxLimit, estimate))
+            self.__resetWindow()
+        return self.limit
+
+    def sample(self, rtt):
+        pass
+
+    def adjust(self, rtt, inflight, dropped):
+        raise NotImplementedError
+
+    def __resetWindow(self):
+        self.windowSamples = 0
+        self.windowRtt = 0.0
+        self.windowInflight = 0
+        self.windowDropped = False
+
+
+class AimdLimit(AdaptiveLimit):
+    '''
+        additive increase while the limit is in use, multiplicative decrease
+        on a timeout, a connection error or a response slower than rttThreshold
+    '''
+    def __init__(self, backoffRatio=DEFAULT_AIMD_BACKOFF_RATIO, rttThreshold=0, **config):
+        AdaptiveLimit.__init__(self, **config)
+        self.backoffRatio = backoffRatio
+        # 0 to only back off on errors
+        self.rttThreshold = rttThreshold
+        self.slow = False
+
+    def sample(self, rtt):
+        if self.rttThreshold and rtt > self.rttThreshold:
+            self.slow = True
+
+    def adjust(self, rtt, inflight, dropped):
+        slow, self.slow = self.slow, False
+        if dropped or slow:
+            return self.estimate * self.backoffRatio
+        if inflight * 2 >= self.estimate:
+            return self.estimate + 1
+        return self.estimate
+
+
+class GradientLimit(AdaptiveLimit):
+    '''
+        scales the limit by the ratio of the no-load RTT to the current one:
+        it grows while latency stays at the baseline and shrinks once requests
+        start to queue at the provider. every probeInterval windows the
+        baseline is measured again at half the limit, so it follows the provider
+    '''
+    def __init__(self, smoothing=DEFAULT_GRADIENT_SMOOTHING, tolerance=DEFAULT_GRADIENT_TOLERANCE,
+                 probeInterval=DEFAULT_GRADIENT_PROBE_INTERVAL, **config):
+        AdaptiveLimit.__init__(self, **config)
+        self.smoothing = smoothing
+        self.tolerance = tolerance
+        self.probeInterval = probeInterval
+        self.minRtt = 0.0
+        self.windows = 0
+
+    def sample(self, rtt):
+        if rtt > 0 and (not self.minRtt or rtt < self.minRtt):
+            self.minRtt = rtt
+
+    def adjust(self, rtt, inflight, dropped):
+        self.windows += 1
+        if self.windows % self.probeInterval == 0:
+            self.minRtt = 0.0
+            return self.estimate / 2
+
+        if dropped:
+            gradient = 0.5
+        elif inflight * 2 < self.estimate or rtt <= 0:
+            # not using the limit, no evidence it can grow
+            return self.estimate
+        else:
+            gradient = max(0.5, min(1.0, self.tolerance * self.minRtt / rtt))
+
+        # the square root term leaves a little queue at the provider
+        newLimit = self.estimate * gradient + self.estimate ** 0.5
+        return self.estimate * (1 - self.smoothing) + newLimit * self.smoothing
+
+
+ADAPTIVE_LIMITS = {
+    'aimd': AimdLimit,
+    'gradient': GradientLimit,
+}
+
+
+def createAdaptiveLimit(name, **config):
+    if name not in ADAPTIVE_LIMITS:
+        raise KeyError('unknown adaptive limit ' + str(name))
+    return ADAPTIVE_LIMITS[name](**config)
@@ -1,115 +1,389 @@
 import asyncio
-import socket
+import functools
+import os
 from . import protocol
+from ._pool import ConnectionPool
+from .constants import HEARTBEAT_TIMEOUT_TIMES, DEFAULT_FLUSH_BYTES, DEFAULT_FLUSH_DELAY, DEFAULT_WEIGHT, \
+    DEFAULT_CONNECT_TIMEOUT, CONNECTION_CONNECTING, CONNECTION_READY, CONNECTION_DRAINING, CONNECTION_CLOSED, KEY_PATH
+from .loadbalance import PeakEwma
+from ._limiter import ConcurrencyLimiter, createAdaptiveLimit
+from ._breaker import CircuitBreaker
 
 
-class Endpoint(object):
-    def __init__(self, addr):
+# objects inherited from the parent process by a fork. they are kept alive so that
+# garbage collection never closes them through the event loop shared with the parent
+_inherited = []
+
+
+# statuses blaming the call, a wrong interface, version or request, not the health of the provider
+_CALLER_STATUSES = (protocol.DubboResponse.SERVICE_NOT_FOUND, protocol.DubboResponse.BAD_REQUEST,
+                    protocol.DubboResponse.CLIENT_ERROR)
+
+
+def _str(name):
+    return name.decode('utf-8') if type(name) == bytes else name
+
+
+class Endpoint(asyncio.Protocol):
+    '''
+        one long-lived connection to a provider, shared by many requests.
+        responses are routed to the waiting request by the request id in the header
+    '''
+    def __init__(self, addr, heartbeat=0, flushBytes=DEFAULT_FLUSH_BYTES, flushDelay=DEFAULT_FLUSH_DELAY):
         self.addr = addr
+        self.heartbeat = heartbeat
+        self.state = CONNECTION_CONNECTING
+        self.transport = None
+        # frames written in one loop tick are flushed together
+        self.flushBytes = flushBytes
+        self.flushDelay = flushDelay
+        self.outgoing = []
+        self.outgoingBytes = 0
+        self.flushHandle = None
+        self.framesWritten = 0
+        self.flushes = 0
+        self.decoder = protocol.FrameDecoder()
+        self.heartbeatTask = None
+        self.pending = {}
+        self.lastRead = 0.0
+        self.lastWrite = 0.0
+        # called once with this endpoint when the connection goes away
+        self.onClosed = None
+        # bookkeeping for the connection pool
+        self.leased = 0
+        self.createdAt = 0.0
+        self.lastUsed = 0.0
+
+    @property
+    def connected(self):
+        return self.state in (CONNECTION_READY, CONNECTION_DRAINING) and not self.transport.is_closing()
+
+    @property
+    def inflight(self):
+        return len(self.pending)
 
     async def init_connection(self):
         host, port = self.addr
-        while True:
-            sock_coroutine = asyncio.open_connection(host, port, flags=socket.TCP_NODELAY)
-            try:
-                self.reader, self.writer = await asyncio.wait_for(sock_coroutine, timeout=3)
-                #print('Connected to %s:%s successfully' % self.addr)
-                return
-            except asyncio.TimeoutError:
-                print('Tried to connect to %s:%s, timeout' % self.addr)
-                sock_coroutine.close()
-                continue
-            except OSError as e:
-                print('OSError', e)
-            except Exception as e:
-                print('Exception', e)
+        loop = asyncio.get_running_loop()
+        sock_coroutine = loop.create_connection(lambda: self, host, port)
+        try:
+            await asyncio.wait_for(sock_coroutine, timeout=DEFAULT_CONNECT_TIMEOUT)
+            #print('Connected to %s:%s successfully' % self.addr)
+        except asyncio.TimeoutError:
+            self.close_connection()
+            # not a call timeout, it must not be taken for one
+            raise ConnectionError('connect to %s:%s timeout' % self.addr)
+        except BaseException:
+            self.close_connection()
+            raise
+        self.state = CONNECTION_READY
+        self.lastRead = self.lastWrite = loop.time()
+        if self.heartbeat:
+            self.heartbeatTask = asyncio.ensure_future(self.__heartbeatLoop())
+
+    def drain(self):
+        # finish the requests in flight, take no new ones
+        if self.state == CONNECTION_READY:
+            self.state = CONNECTION_DRAINING
 
     def close_connection(self):
+        if self.state == CONNECTION_CLOSED:
+            return False
+        # queued frames, oneway calls among them, go out while the transport is still open
+        self.flush()
+        self.state = CONNECTION_CLOSED
+        if self.heartbeatTask is not None and self.heartbeatTask is not asyncio.current_task():
+            self.heartbeatTask.cancel()
+        self.heartbeatTask = None
+        self.__failPending(ConnectionError('connection to %s:%s closed' % self.addr))
+        onClosed, self.onClosed = self.onClosed, None
+        if onClosed is not None:
+            onClosed(self)
+        # a partly received frame dies with its connection
+        self.decoder = protocol.FrameDecoder()
         try:
-            self.writer.close()
+            self.transport.close()
             return True
         except:
             return False
 
-    async def send(self, data):
-        self.writer.write(data)
+    def connection_made(self, transport):
+        self.transport = transport
 
-    async def __recv(self, length):
-        while True:
-            try:
-                data = await self.reader.read(length)
-            except (TimeoutError, asyncio.TimeoutError):
-                print('Server %s:%s timeout, reconnect' % self.addr)
-                data = None
-
-            if not data:
-                print('no data')
-                self.working = False
-                await self.init_connection()
-                continue
-            return data
+    def detach(self):
+        '''
+            after a fork, release the socket inherited from the parent without
+            touching the parent's event loop
+        '''
+        if self.transport is not None:
+            sock = self.transport.get_extra_info('socket')
+            if sock is not None and sock.fileno() >= 0:
+                try:
+                    os.close(sock.fileno())
+                except OSError:
+                    pass
+        _inherited.append(self)
+
+    def connection_lost(self, exc):
+        self.close_connection()
+
+    def data_received(self, data):
+        self.decoder.feed(data)
+        # all the frames of one segment are dispatched in this callback
+        try:
+            for header, body in self.decoder.frames():
+                try:
+                    response = self.response_handler(header, body)
+                except Exception as e:
+                    # only the call answered by this frame fails, the connection is still usable
+                    future = self.pending.pop(header[3], None)
+                    if future is not None and not future.done():
+                        future.set_exception(e)
+                    continue
+                if response is None:
+                    continue
+                future = self.pending.pop(response.rid, None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except ValueError as e:
+            # the stream cannot be split into frames any more
+            print('Bad frame from %s:%s, close connection: %s' % (tuple(self.addr) + (e,)))
+            self.close_connection()
+
+    def write(self, *data):
+        self.outgoing.extend(data)
+        self.outgoingBytes += sum(len(d) for d in data)
+        self.framesWritten += 1
+        if self.outgoingBytes >= self.flushBytes:
+            self.flush()
+        elif self.flushHandle is None:
+            loop = asyncio.get_running_loop()
+            if self.flushDelay:
+                self.flushHandle = loop.call_later(self.flushDelay, self.flush)
+            else:
+                self.flushHandle = loop.call_soon(self.flush)
+
+    def flush(self):
+        if self.flushHandle is not None:
+            self.flushHandle.cancel()
+            self.flushHandle = None
+        if not self.outgoing:
+            return
+        outgoing, self.outgoing = self.outgoing, []
+        self.outgoingBytes = 0
+        if self.connected:
+            self.transport.writelines(outgoing)
+            self.flushes += 1
+
+    async def send(self, *data):
+        self.write(*data)
+        self.lastWrite = asyncio.get_running_loop().time()
+
+    async def request(self, request):
+        if self.state != CONNECTION_READY:
+            raise ConnectionError('connection to %s:%s is %s' % (tuple(self.addr) + (self.state,)))
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request.rid] = future
+        try:
+            await self.send(protocol.encodeRequest(request))
+            return await future
+        finally:
+            self.pending.pop(request.rid, None)
 
     def response_handler(self, header, data):
         obj = protocol.decode(header, data)
+        self.lastRead = asyncio.get_running_loop().time()
 
         if obj.isHeartbeat:
+            if isinstance(obj, protocol.DubboRequest) and obj.isTwoWay:
+                # heartbeat sent by the provider, answer it
+                response = protocol.DubboResponse(obj.rid)
+                response.isEvent = True
+                self.write(protocol.encodeResponse(response))
             return
         return obj
 
-    async def receive(self):
-        # Wait for connection done.
-        # await self._working.wait()
+    async def __heartbeatLoop(self):
+        loop = asyncio.get_running_loop()
         while True:
-            header = await self.__recv(protocol.HEADER_LENGTH)
-            if header[:2] != protocol.MAGIC_NUMBER:
-                continue
-            while len(header) < protocol.HEADER_LENGTH:
-                temp = await self.__recv(protocol.HEADER_LENGTH - len(header))
-                header += temp
-            dataLength = protocol.getDataLength(header)
-            data = b''
-            while len(data) < dataLength:
-                temp = await self.__recv(dataLength - len(data))
-                data += temp
+            await asyncio.sleep(self.heartbeat)
+            now = loop.time()
+            if now - self.lastRead > self.heartbeat * HEARTBEAT_TIMEOUT_TIMES:
+                print('Heartbeat of %s:%s timeout, close connection' % self.addr)
+                self.close_connection()
+                return
+            if now - self.lastRead >= self.heartbeat or now - self.lastWrite >= self.heartbeat:
+                await self.send(protocol.encodeRequest(protocol.DubboRequest(event=True)))
 
-            return self.response_handler(header, data)
+    def __failPending(self, exc):
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(exc)
 
 
 class DubboChannel(object):
-    def __init__(self, addr):
+    '''
+        all the calls to one provider, multiplexed over the endpoints of a connection pool
+    '''
+    def __init__(self, addr, poolConfig=None, heartbeat=0, flushBytes=DEFAULT_FLUSH_BYTES, flushDelay=DEFAULT_FLUSH_DELAY,
+                 weight=DEFAULT_WEIGHT, limitConfig=None, breakerConfig=None):
         self.addr = addr
-        self.sockets = {}
-
-    async def send_request(self, message, request_id=None, new_conn=True):
-        # connected to server
-        if request_id:
-            if new_conn:
-                # get socket from records
-                endpoint = Endpoint(self.addr)
-                self.sockets[request_id] = endpoint
-                await endpoint.init_connection()
-            else:
-                endpoint = self.sockets[request_id]
+        self.breaker = CircuitBreaker('%s:%s' % addr, **(breakerConfig or {}))
+        # load balancing inputs
+        self.weight = weight
+        self.active = 0
+        # resolved by the last request in flight once close is draining
+        self.drained = None
+        self.latency = PeakEwma()
+        endpointFactory = functools.partial(Endpoint, heartbeat=heartbeat, flushBytes=flushBytes, flushDelay=flushDelay)
+        self.pool = ConnectionPool(addr, endpointFactory, **(poolConfig or {}))
+        # in-flight caps of the whole channel and of each method
+        limitConfig = dict(limitConfig or {})
+        maxInflight = limitConfig.pop('maxInflight', 0)
+        adaptive = limitConfig.pop('adaptive', None)
+        if adaptive:
+            # the channel limit follows the measured latency instead of maxInflight
+            adaptiveConfig = limitConfig.pop('adaptiveConfig', {})
+            self.adaptive = createAdaptiveLimit(adaptive, **adaptiveConfig)
+            maxInflight = self.adaptive.limit
         else:
-            # plastic use
-            endpoint = Endpoint(self.addr)
-            await endpoint.init_connection()
+            self.adaptive = None
+        self.queueConfig = limitConfig
+        self.limiter = ConcurrencyLimiter('%s:%s' % addr, maxInflight, **self.queueConfig)
+        # (path, method name) -> ConcurrencyLimiter
+        self.methodLimiters = {}
+
+    def available(self):
+        return self.breaker.available()
+
+    async def send_request(self, message, timeout=None, actives=0):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        # set by __call once the request holds its limiter slots, so RTT samples exclude queueing
+        sent = []
+        dropped = False
+        # error responses do not say the provider is overloaded, but it is not healthy either
+        failed = True
+        probe = self.breaker.onStart()
+        self.active += 1
+        try:
+            if not timeout:
+                response = await self.__call(message, actives, sent)
+            else:
+                # on expiry the request id is dropped from the endpoint, so a late
+                # response is discarded and the connection stays usable
+                response = await asyncio.wait_for(self.__call(message, actives, sent), timeout)
+            failed = response.status != protocol.DubboResponse.OK
+            if failed:
+                if response.status in _CALLER_STATUSES:
+                    # one bad reference config must not eject the provider for every other interface
+                    failed = None
+                raise protocol.DubboStatusException(response.status, response.errorMsg)
+            if response.exception is not None:
+                raise protocol.DubboException(response.exception)
+            return response.result
+        except asyncio.TimeoutError:
+            dropped = True
+            raise protocol.DubboTimeoutException(
+                'waiting response of request %s from %s:%s timeout, timeout = %ss'
+                % ((message.rid,) + tuple(self.addr) + (timeout,)))
+        except protocol.DubboRejectedException:
+            # never reached the provider, says nothing about its latency
+            start = None
+            raise
+        except (ConnectionError, OSError):
+            dropped = True
+            raise
+        except asyncio.CancelledError:
+            # given up by the caller, no verdict on the provider
+            failed = None
+            raise
+        finally:
+            self.active -= 1
+            if not self.active and self.drained is not None and not self.drained.done():
+                self.drained.set_result(None)
+            now = loop.time()
+            if start is not None:
+                self.latency.observe(now - start)
+            if start is None or failed is None:
+                self.breaker.skip(probe)
+            else:
+                self.breaker.record(not failed, now - start, probe)
+            if self.adaptive is not None and sent and (dropped or start is not None):
+                self.limiter.limit = self.adaptive.update(now - sent[0], self.limiter.active, dropped)
+
+    async def __call(self, message, actives, sent):
+        # take the narrower method slot first, so queued calls of one method
+        # do not hold channel slots other methods could use
+        limiters = [self.limiter]
+        if actives:
+            path = _str(message.data.attachments.get(KEY_PATH))
+            limiters.insert(0, self.__methodLimiter(path, _str(message.data.getMethodName()), actives))
+        acquired = []
+        try:
+            for limiter in limiters:
+                await limiter.acquire()
+                acquired.append(limiter)
+            sent.append(asyncio.get_running_loop().time())
+            endpoint = await self.pool.acquire()
+            try:
+                response = await endpoint.request(message)
+            finally:
+                self.pool.release(endpoint)
+        finally:
+            for limiter in acquired:
+                limiter.release()
+        return response
 
-        data = protocol.encodeRequest(message)
+    def __methodLimiter(self, path, methodName, actives):
+        # actives is a setting of the method of one interface, as the url + method of dubbo
+        key = (path, methodName)
+        limiter = self.methodLimiters.get(key)
+        if limiter is None:
+            name = '%s:%s' % self.addr + ' %s.%s' % key
+            limiter = self.methodLimiters[key] = ConcurrencyLimiter(name, actives, **self.queueConfig)
+        elif limiter.limit != actives:
+            limiter.limit = actives
+        return limiter
 
-        # send request
-        await endpoint.send(data)
+    async def send(self, message):
+        message.isTwoWay = False
+        endpoint = await self.pool.acquire()
+        try:
+            await endpoint.send(protocol.encodeRequest(message))
+        finally:
+            self.pool.release(endpoint)
 
-        # receive response
-        response = await endpoint.receive()
+    def stats(self):
+        return {
+            'weight': self.weight,
+            'active': self.active,
+            'latency': self.latency.get(),
+            'pool': self.pool.stats(),
+            'health': self.breaker.stats(),
+            'limiter': self.limiter.stats(),
+            'adaptive': type(self.adaptive).__name__ if self.adaptive else None,
+            'methods': dict(('%s.%s' % key, limiter.stats()) for key, limiter in self.methodLimiters.items()),
+        }
 
-        # close socket
-        if request_id:
-            if not new_conn:
-                endpoint.close_connection()
-        else:
-            endpoint.close_connection()
-        return response.result
+    async def warmup(self):
+        await self.pool.warmup()
+
+    def detach(self):
+        for endpoint in self.pool.endpoints + self.pool.retired:
+            endpoint.detach()
+        _inherited.append(self)
+
+    async def drain(self):
+        '''
+            waits until no request is in flight
+        '''
+        if self.active:
+            if self.drained is None or self.drained.done():
+                self.drained = asyncio.get_running_loop().create_future()
+            await asyncio.shield(self.drained)
 
-    def close(self, request_id):
-        self.sockets[request_id].close_connection()
+    def close(self):
+        # pending oneway writes are flushed as the connections close
+        self.pool.close()
@@ -0,0 +1,290 @@
+import asyncio
+import collections
+import random
+import time
+
+from .constants import *
+from .protocol import DubboTimeoutException
+
+
+class ConnectionPool(object):
+    '''
+        bounded set of multiplexed endpoints to one provider address.
+        an endpoint is busy once it carries maxRequests leases, callers that
+        find every endpoint busy wait in a FIFO queue
+    '''
+    def __init__(self, addr, endpointFactory, minConnections=DEFAULT_POOL_MIN_CONNECTIONS,
+                 maxConnections=DEFAULT_CONNECTIONS, maxRequests=DEFAULT_POOL_MAX_REQUESTS,
+                 idleTimeout=DEFAULT_POOL_IDLE_TIMEOUT, maxLifetime=DEFAULT_POOL_MAX_LIFETIME,
+                 waitTimeout=DEFAULT_POOL_WAIT_TIMEOUT, backoffBase=DEFAULT_POOL_BACKOFF_BASE,
+                 backoffMax=DEFAULT_POOL_BACKOFF_MAX, backoffJitter=DEFAULT_POOL_BACKOFF_JITTER):
+        self.addr = addr
+        self.endpointFactory = endpointFactory
+        self.maxConnections = max(maxConnections, 1)
+        self.minConnections = min(minConnections, self.maxConnections)
+        self.maxRequests = maxRequests
+        self.idleTimeout = idleTimeout
+        self.maxLifetime = maxLifetime
+        self.waitTimeout = waitTimeout
+        # reconnects after failures wait backoffBase * 2 ** (failures - 1), at most backoffMax,
+        # minus up to backoffJitter of it so that clients do not reconnect in step
+        self.backoffBase = backoffBase
+        self.backoffMax = backoffMax
+        self.backoffJitter = backoffJitter
+        self.connectFailures = 0
+        self.backoffUntil = 0.0
+
+        self.endpoints = []
+        self.retired = []
+        self.opening = 0
+        self.waiters = collections.deque()
+        self.reaper = None
+        self.closed = False
+
+        self.checkouts = 0
+        self.waits = 0
+        self.waitTime = 0.0
+        self.maxWaitTime = 0.0
+        self.waitTimeouts = 0
+        self.created = 0
+        self.evicted = 0
+        self.connectErrors = 0
+
+    @property
+    def size(self):
+        return len(self.endpoints) + self.opening
+
+    @property
+    def state(self):
+        if any(endpoint.connected for endpoint in self.endpoints):
+            return CONNECTION_READY
+        if self.connectFailures and time.monotonic() < self.backoffUntil:
+            return CONNECTION_BACKOFF
+        if self.opening:
+            return CONNECTION_CONNECTING
+        return CONNECTION_CLOSED
+
+    async def acquire(self):
+        if self.closed:
+            raise ConnectionError('pool of %s:%s closed' % self.addr)
+        self.__startReaper()
+        if not self.waiters:
+            endpoint = self.__pick()
+            if endpoint is not None:
+                self.__lease(endpoint)
+                return endpoint
+
+        loop = asyncio.get_running_loop()
+        if not self.endpoints and self.connectFailures and time.monotonic() < self.backoffUntil:
+            # do not queue behind a provider that is down, let the caller go elsewhere
+            raise ConnectionError('%s:%s is unreachable, reconnect in %.2fs'
+                                  % (tuple(self.addr) + (self.backoffUntil - time.monotonic(),)))
+        waiter = loop.create_future()
+        self.waiters.append(waiter)
+        self.__wakeWaiters()
+
+        start = loop.time()
+        try:
+            if self.waitTimeout:
+                return await asyncio.wait_for(waiter, self.waitTimeout)
+            return await waiter
+        except asyncio.TimeoutError:
+            self.waitTimeouts += 1
+            raise DubboTimeoutException('wait for connection to %s:%s timeout' % self.addr)
+        except BaseException:
+            # handed an endpoint just before we gave up on it
+            if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                self.release(waiter.result())
+            raise
+        finally:
+            if not waiter.done():
+                waiter.cancel()
+            elapsed = loop.time() - start
+            self.waits += 1
+            self.waitTime += elapsed
+            self.maxWaitTime = max(self.maxWaitTime, elapsed)
+
+    def release(self, endpoint):
+        endpoint.leased -= 1
+        endpoint.lastUsed = asyncio.get_running_loop().time()
+        if endpoint in self.retired:
+            if endpoint.leased <= 0:
+                self.retired.remove(endpoint)
+                endpoint.close_connection()
+        elif endpoint not in self.endpoints:
+            return
+        elif not endpoint.connected:
+            self.__evict(endpoint)
+        else:
+            self.__wakeWaiters()
+
+    def maintain(self):
+        if self.closed:
+            return
+        now = asyncio.get_running_loop().time()
+        for endpoint in list(self.endpoints):
+            if not endpoint.connected:
+                self.__evict(endpoint)
+            elif self.maxLifetime and now - endpoint.createdAt > self.maxLifetime:
+                self.__evict(endpoint)
+            elif endpoint.leased <= 0 and self.idleTimeout \
+                    and now - endpoint.lastUsed > self.idleTimeout \
+                    and len(self.endpoints) > self.minConnections:
+                self.__evict(endpoint)
+        for i in range(self.minConnections - self.size):
+            self.__spawn()
+
+    def close(self):
+        self.closed = True
+        if self.reaper:
+            self.reaper.cancel()
+            self.reaper = None
+        endpoints = self.endpoints + self.retired
+        self.endpoints = []
+        self.retired = []
+        for endpoint in endpoints:
+            endpoint.close_connection()
+        self.__failWaiters(ConnectionError('pool of %s:%s closed' % self.addr))
+
+    def stats(self):
+        return {
+            'size': len(self.endpoints),
+            'opening': self.opening,
+            'busy': len([e for e in self.endpoints if self.maxRequests and e.leased >= self.maxRequests]),
+            'leased': sum(e.leased for e in self.endpoints),
+            'waiting': len(self.waiters),
+            'checkouts': self.checkouts,
+            'waits': self.waits,
+            'waitTime': self.waitTime,
+            'maxWaitTime': self.maxWaitTime,
+            'waitTimeouts': self.waitTimeouts,
+            'created': self.created,
+            'evicted': self.evicted,
+            'state': self.state,
+            'connectErrors': self.connectErrors,
+            'framesWritten': sum(e.framesWritten for e in self.endpoints),
+            'flushes': sum(e.flushes for e in self.endpoints),
+        }
+
+    def __pick(self):
+        best = None
+        for endpoint in self.endpoints:
+            if not endpoint.connected:
+                continue
+            if self.maxRequests and endpoint.leased >= self.maxRequests:
+                continue
+            if best is None or endpoint.leased < best.leased:
+                best = endpoint
+        return best
+
+    def __lease(self, endpoint):
+        endpoint.leased += 1
+        self.checkouts += 1
+
+    async def warmup(self):
+        '''
+            opens connections up to minConnections, at least one
+        '''
+        if self.closed:
+            return
+        self.__startReaper()
+        growing = []
+        for i in range(max(self.minConnections, 1) - self.size):
+            self.opening += 1
+            growing.append(self.__grow())
+        await asyncio.gather(*growing)
+
+    def __wakeWaiters(self):
+        while self.waiters:
+            if self.waiters[0].done():
+                self.waiters.popleft()
+                continue
+            endpoint = self.__pick()
+            if endpoint is None:
+                if self.size < self.maxConnections:
+                    self.__spawn()
+                return
+            self.__lease(endpoint)
+            self.waiters.popleft().set_result(endpoint)
+
+    def __evict(self, endpoint):
+        self.endpoints.remove(endpoint)
+        self.evicted += 1
+        if endpoint.leased > 0 and endpoint.connected:
+            # let the requests on it finish, hand out no new ones
+            endpoint.drain()
+            self.retired.append(endpoint)
+        else:
+            endpoint.close_connection()
+
+    def __closed(self, endpoint):
+        # broken or heartbeat timeout: drop it and open a replacement if anyone needs one
+        if endpoint in self.endpoints:
+            self.endpoints.remove(endpoint)
+            self.evicted += 1
+            if self.size < self.minConnections:
+                self.__spawn()
+            self.__wakeWaiters()
+        elif endpoint in self.retired:
+            self.retired.remove(endpoint)
+
+    def __failWaiters(self, exc):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_exception(exc)
+
+    def __spawn(self):
+        if self.closed:
+            return
+        # count the connection before its task runs so concurrent callers respect maxConnections
+        self.opening += 1
+        asyncio.ensure_future(self.__grow())
+
+    async def __grow(self):
+        try:
+            delay = self.backoffUntil - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            endpoint = self.endpointFactory(self.addr)
+            await endpoint.init_connection()
+        except asyncio.CancelledError:
+            self.opening -= 1
+            raise
+        except Exception as e:
+            self.opening -= 1
+            self.__backoff(e)
+            if not self.endpoints:
+                self.__failWaiters(e)
+            return
+        self.opening -= 1
+        if self.closed:
+            # the pool was closed while this connection was opening
+            endpoint.close_connection()
+            return
+        self.connectFailures = 0
+        endpoint.createdAt = endpoint.lastUsed = asyncio.get_running_loop().time()
+        endpoint.onClosed = self.__closed
+        self.endpoints.append(endpoint)
+        self.created += 1
+        self.__wakeWaiters()
+
+    def __backoff(self, e):
+        self.connectFailures += 1
+        self.connectErrors += 1
+        delay = min(self.backoffBase * 2 ** min(self.connectFailures - 1, 30), self.backoffMax)
+        delay *= 1 - self.backoffJitter * random.random()
+        # monotonic and not the loop clock, state is read by stats() from any thread
+        self.backoffUntil = time.monotonic() + delay
+        print('Connect to %s:%s failed, %s, retry in %.2fs' % (tuple(self.addr) + (e, delay)))
+
+    def __startReaper(self):
+        if self.reaper is None or self.reaper.done():
+            self.reaper = asyncio.ensure_future(self.__reap())
+
+    async def __reap(self):
+        interval = min([t for t in (self.idleTimeout, self.maxLifetime) if t] or [DEFAULT_POOL_REAP_INTERVAL])
+        interval = min(interval / 2, DEFAULT_POOL_REAP_INTERVAL)
+        while True:
+            await asyncio.sleep(interval)
+            self.maintain()
@@ -21,7 +21,7 @@ def printByteStr(encodeStr) :
     outstr = ''
     col = 0
     for c in encodeStr :
-        outstr += '%02x ' % (ord(c))
+        outstr += '%02x ' % (c if isinstance(c, int) else ord(c))
         col += 1
         if col >= 16 :
             col = 0
@@ -0,0 +1,266 @@
+import asyncio
+import collections
+
+from . import protocol
+from .constants import *
+
+
+class Cluster(object):
+    '''
+        decides which providers a call is sent to and what happens when it fails.
+        client offers select(request, excluded) to pick a channel and
+        call(channel, request, timeout) to send the request on it
+    '''
+    async def invoke(self, client, request, timeout):
+        raise NotImplementedError
+
+    def stats(self):
+        return None
+
+
+class FailfastCluster(Cluster):
+    '''
+        one provider, any error goes to the caller
+    '''
+    async def invoke(self, client, request, timeout):
+        return (await client.call(client.select(request), request, timeout))
+
+
+class FailoverCluster(Cluster):
+    '''
+        on error the call is tried again on up to retries other providers, within the
+        deadline of the original call. a request that may have reached the provider is
+        only sent again for methods configured as idempotent
+    '''
+    def __init__(self):
+        # counted instead of printed, a degraded provider fails every call
+        self.retries = 0
+        self.lastError = None
+
+    async def invoke(self, client, request, timeout):
+        attachments = request.data.attachments
+        retries = attachments.get(KEY_RETRIES, DEFAULT_RETRIES)
+        idempotent = attachments.get(KEY_IDEMPOTENT, False)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout else None
+
+        excluded = []
+        error = None
+        for attempt in range(retries + 1):
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+            if error is not None:
+                self.retries += 1
+                self.lastError = '%s: %s' % (_methodName(request), error)
+            channel = client.select(request, excluded)
+            try:
+                return (await client.call(channel, request, remaining))
+            except Exception as e:
+                if attempt == retries or not _retriable(e, idempotent):
+                    raise
+                error = e
+                excluded.append(channel)
+        if error is not None:
+            # the deadline ran out before the next attempt, the caller gets the error of the last one
+            raise error
+        raise protocol.DubboTimeoutException('no time left to call %s, timeout = %ss' % (_methodName(request), timeout))
+
+    def stats(self):
+        return {'retries': self.retries, 'lastError': self.lastError}
+
+
+class FailsafeCluster(Cluster):
+    '''
+        errors are counted and the configured defaultValue is returned instead
+    '''
+    def __init__(self):
+        self.ignored = 0
+        self.lastError = None
+
+    async def invoke(self, client, request, timeout):
+        try:
+            return (await client.call(client.select(request), request, timeout))
+        except Exception as e:
+            self.ignored += 1
+            self.lastError = '%s: %s' % (_methodName(request), e)
+            return request.data.attachments.get(KEY_DEFAULT_VALUE)
+
+    def stats(self):
+        return {'ignored': self.ignored, 'lastError': self.lastError}
+
+
+class ForkingCluster(Cluster):
+    '''
+        the call is sent to forks providers at once, the first success is returned
+        and the other calls are cancelled. fails only when every fork failed
+    '''
+    async def invoke(self, client, request, timeout):
+        forks = request.data.attachments.get(KEY_FORKS, DEFAULT_FORKS)
+        channels = []
+        for i in range(forks):
+            channel = client.select(request, channels)
+            if channel in channels:
+                # fewer providers than forks
+                break
+            channels.append(channel)
+        if len(channels) == 1:
+            return (await client.call(channels[0], request, timeout))
+
+        pending = set(asyncio.ensure_future(client.call(channel, request, timeout)) for channel in channels)
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+class HedgeState(object):
+    '''
+        recent latencies of one method, the hedge budget and counters
+    '''
+    def __init__(self):
+        self.samples = collections.deque(maxlen=DEFAULT_HEDGE_SAMPLES)
+        self.sorted = []
+        self.stale = 0
+        self.tokens = 0.0
+        self.calls = 0
+        self.hedges = 0
+        self.wins = 0
+
+    def observe(self, latency):
+        self.samples.append(latency)
+        self.stale += 1
+
+    def delay(self, percentile):
+        if len(self.samples) < DEFAULT_HEDGE_MIN_SAMPLES:
+            return None
+        # sorting on every call is too slow, the delay may lag a few calls behind
+        if self.stale >= DEFAULT_HEDGE_RESORT or not self.sorted:
+            self.sorted = sorted(self.samples)
+            self.stale = 0
+        index = min(len(self.sorted) - 1, int(len(self.sorted) * percentile / 100.0))
+        return self.sorted[index]
+
+    def earn(self, budget):
+        # every call adds budget tokens and a hedge costs one, bursts are capped
+        self.calls += 1
+        self.tokens = min(self.tokens + budget, DEFAULT_HEDGE_MAX_TOKENS)
+
+    def spend(self):
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        self.hedges += 1
+        return True
+
+    def stats(self, percentile):
+        return {
+            'calls': self.calls,
+            'hedges': self.hedges,
+            'wins': self.wins,
+            'delay': self.delay(percentile),
+        }
+
+
+class HedgingCluster(Cluster):
+    '''
+        a call still running after the hedgePercentile of the recent latencies of
+        its method is sent again to another provider. the first response wins and
+        the other call is cancelled. hedges are limited to hedgeBudget of the calls.
+        only for idempotent methods
+    '''
+    def __init__(self):
+        self.states = {}
+        self.percentiles = {}
+
+    async def invoke(self, client, request, timeout):
+        attachments = request.data.attachments
+        percentile = attachments.get(KEY_HEDGE_PERCENTILE, DEFAULT_HEDGE_PERCENTILE)
+        key = (attachments.get(KEY_PATH), _methodName(request))
+        state = self.states.get(key)
+        if state is None:
+            state = self.states[key] = HedgeState()
+        self.percentiles[key] = percentile
+        state.earn(attachments.get(KEY_HEDGE_BUDGET, DEFAULT_HEDGE_BUDGET))
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        channel = client.select(request)
+        primary = asyncio.ensure_future(client.call(channel, request, timeout))
+        pending = {primary}
+        done = set()
+        try:
+            delay = state.delay(percentile)
+            if delay is not None and (not timeout or delay < timeout):
+                done, pending = await asyncio.wait(pending, timeout=delay)
+                if pending:
+                    other = client.select(request, [channel])
+                    if other is not channel and state.spend():
+                        remaining = timeout - (loop.time() - start) if timeout else None
+                        pending.add(asyncio.ensure_future(client.call(other, request, remaining)))
+            while True:
+                if not done:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                task = done.pop()
+                if task.exception() is None or not (done or pending):
+                    break
+            if task.exception() is None:
+                state.observe(loop.time() - start)
+                if task is not primary:
+                    state.wins += 1
+            return task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self):
+        return dict(('%s.%s' % (_str(path), name), state.stats(self.percentiles[(path, name)]))
+                    for (path, name), state in self.states.items())
+
+
+def _retriable(e, idempotent):
+    if isinstance(e, protocol.DubboRejectedException):
+        # never sent
+        return True
+    if not idempotent:
+        return False
+    return isinstance(e, (protocol.DubboTimeoutException, protocol.DubboStatusException, ConnectionError, OSError))
+
+
+def _str(name):
+    return name.decode('utf-8') if type(name) == bytes else name
+
+
+def _methodName(request):
+    return _str(request.data.getMethodName())
+
+
+CLUSTERS = {
+    'failover': FailoverCluster,
+    'failfast': FailfastCluster,
+    'failsafe': FailsafeCluster,
+    'forking': ForkingCluster,
+    'hedging': HedgingCluster,
+}
+
+
+def registerCluster(name, cls):
+    CLUSTERS[name] = cls
+
+
+def createCluster(name):
+    if isinstance(name, Cluster):
+        return name
+    if name not in CLUSTERS:
+        raise KeyError('unknown cluster ' + str(name))
+    return CLUSTERS[name]()
@@ -7,18 +7,115 @@ KEY_REFERENCE = 'reference'
 KEY_PATH = 'path'
 KEY_INTERFACE = 'interface'
 KEY_VERSION = 'version'
+KEY_GROUP = 'group'
 KEY_ASYNC = 'async'
 KEY_WITH_RETURN = 'withReturn'
 KEY_CLASSPATH = 'classpath'
 KEY_DUBBO_OWNER = 'owner'
 KEY_DUBBO_CUSTOMER = 'customer'
 KEY_HEARTBEAT = 'heartbeat'
+KEY_CONNECTIONS = 'connections'
+KEY_POOL = 'pool'
+KEY_FLUSH_BYTES = 'flushBytes'
+KEY_FLUSH_DELAY = 'flushDelay'
+KEY_LOADBALANCE = 'loadbalance'
+KEY_HASH_ARGUMENTS = 'hashArguments'
+KEY_LIMIT = 'limit'
+KEY_ACTIVES = 'actives'
+KEY_BREAKER = 'breaker'
+KEY_CLUSTER = 'cluster'
+KEY_RETRIES = 'retries'
+KEY_FORKS = 'forks'
+KEY_IDEMPOTENT = 'idempotent'
+KEY_DEFAULT_VALUE = 'defaultValue'
+KEY_HEDGE_PERCENTILE = 'hedgePercentile'
+KEY_HEDGE_BUDGET = 'hedgeBudget'
+KEY_WARMUP = 'warmup'
+KEY_GENERIC = 'generic'
+KEY_DESCRIPTOR = 'descriptor'
+KEY_PARAMETER_TYPES = 'parameterTypes'
+KEY_CACHE = 'cache'
+KEY_BATCH = 'batch'
+KEY_THREADS = 'threads'
+KEY_MAX_REQUESTS = 'maxRequests'
+KEY_SERIALIZATION = 'serialization'
 
 DEFAULT_TIMEOUT = 1
 DEFAULT_SERVICE_VERSION = '0.0.0'
 DEFAULT_HEARTBEAT = 60
+HEARTBEAT_TIMEOUT_TIMES = 3
+DEFAULT_CONNECTIONS = 1
+DEFAULT_POOL_MIN_CONNECTIONS = 0
+DEFAULT_POOL_MAX_REQUESTS = 0
+DEFAULT_POOL_IDLE_TIMEOUT = 600
+DEFAULT_POOL_MAX_LIFETIME = 0
+DEFAULT_POOL_WAIT_TIMEOUT = 0
+DEFAULT_POOL_REAP_INTERVAL = 30
+DEFAULT_POOL_BACKOFF_BASE = 0.1
+DEFAULT_POOL_BACKOFF_MAX = 30
+DEFAULT_POOL_BACKOFF_JITTER = 0.5
+DEFAULT_FLUSH_BYTES = 64 * 1024
+# the largest frame body accepted, as the payload of dubbo
+DEFAULT_PAYLOAD = 8 * 1024 * 1024
+DEFAULT_FLUSH_DELAY = 0
+DEFAULT_WEIGHT = 100
+DEFAULT_LOADBALANCE = 'random'
+DEFAULT_HASH_NODES = 160
+DEFAULT_HASH_ARGUMENTS = [0]
+DEFAULT_EWMA_DECAY = 10
+DEFAULT_EWMA_PENALTY = 1e6
+DEFAULT_BATCH_CONCURRENCY = 64
+DEFAULT_LIMIT_QUEUE_SIZE = 1024
+DEFAULT_LIMIT_QUEUE_TIMEOUT = 0
+DEFAULT_ADAPTIVE_INITIAL_LIMIT = 20
+DEFAULT_ADAPTIVE_MIN_LIMIT = 1
+DEFAULT_ADAPTIVE_MAX_LIMIT = 1000
+DEFAULT_AIMD_BACKOFF_RATIO = 0.9
+DEFAULT_GRADIENT_SMOOTHING = 0.2
+DEFAULT_GRADIENT_TOLERANCE = 1.5
+DEFAULT_GRADIENT_PROBE_INTERVAL = 100
+DEFAULT_ADAPTIVE_MIN_WINDOW = 10
+DEFAULT_CONNECT_TIMEOUT = 3
+DEFAULT_CLOSE_TIMEOUT = 10
+DEFAULT_BREAKER_WINDOW = 10
+DEFAULT_BREAKER_BUCKETS = 10
+DEFAULT_BREAKER_MIN_REQUESTS = 20
+DEFAULT_BREAKER_ERROR_THRESHOLD = 0.5
+DEFAULT_BREAKER_SLOW_CALL_DURATION = 1
+DEFAULT_BREAKER_CONSECUTIVE_ERRORS = 5
+DEFAULT_BREAKER_BASE_EJECTION_TIME = 5
+DEFAULT_BREAKER_MAX_EJECTION_TIME = 300
+DEFAULT_BREAKER_HALF_OPEN_PROBES = 1
+DEFAULT_CLUSTER = 'failover'
+DEFAULT_RETRIES = 2
+DEFAULT_FORKS = 2
+DEFAULT_HEDGE_PERCENTILE = 95
+DEFAULT_HEDGE_BUDGET = 0.05
+DEFAULT_HEDGE_MAX_TOKENS = 10
+DEFAULT_HEDGE_SAMPLES = 1000
+DEFAULT_HEDGE_MIN_SAMPLES = 20
+DEFAULT_HEDGE_RESORT = 50
+DEFAULT_CACHE_TTL = 60
+DEFAULT_CACHE_MAX_ENTRIES = 1000
+DEFAULT_BATCH_WINDOW = 0.002
+DEFAULT_BATCH_MAX_SIZE = 100
+TEMPLATE_CACHE_SIZE = 1024
+DEFAULT_SERVER_THREADS = 200
+DEFAULT_SERVER_MAX_REQUESTS = 1000
 DEFAULT_FUTURE_CHECK_PERIOD = 0.03
 
+# states of a connection, backoff is the state of a pool waiting to reconnect
+CONNECTION_CONNECTING = 'connecting'
+CONNECTION_READY = 'ready'
+CONNECTION_DRAINING = 'draining'
+CONNECTION_CLOSED = 'closed'
+CONNECTION_BACKOFF = 'backoff'
+
+# reference and method settings used by the consumer only, never sent as attachments
+CLIENT_ATTACHMENT_KEYS = {KEY_LOADBALANCE, KEY_HASH_ARGUMENTS, KEY_ACTIVES, KEY_CLUSTER, KEY_RETRIES, KEY_FORKS,
+                          KEY_IDEMPOTENT, KEY_DEFAULT_VALUE, KEY_HEDGE_PERCENTILE, KEY_HEDGE_BUDGET,
+                          KEY_PARAMETER_TYPES, KEY_CACHE, KEY_BATCH, KEY_SERIALIZATION}
+
 DEFAULT_DUBBO_OWNER = 'Dmall'
 DEFAULT_DUBBO_CUSTOMER = 'dmallsh'
 
@@ -1,7 +1,10 @@
 # coding=utf-8
+import asyncio
 import inspect
 import json
+import os
 import uuid
+import weakref
 
 from . import protocol
 from . import hessian2
@@ -14,76 +17,235 @@ import random
 from . import java
 from .constants import *
 from . import _model
+from . import loadbalance
+from . import cluster
+from . import _cache
+from . import _batch
 from ._net import *
+from ._net import _str
 
 __version__ = '0.1.1'
 
 
+def _routingKey(attachments):
+    # the attachments that decide which service answers, results of different ones never mix
+    return tuple(attachments.get(key) for key in (KEY_PATH, KEY_VERSION, KEY_GROUP, KEY_SERIALIZATION))
+
+
+def _routingName(attachments, methodName):
+    path, version, group, serialization = _routingKey(attachments)
+    return '.'.join((_str(path), _str(methodName))) + ''.join(':%s' % getattr(v, 'name', _str(v)) for v in (version, group, serialization) if v)
+
+
 def _getRequestParam(request, key, default=None):
     if key in request.data.attachments:
         return request.data.attachments[key]
     return default
 
 
+# every client of the process, reset in the child after a fork
+_clients = weakref.WeakSet()
+
+
+def _afterFork():
+    for client in list(_clients):
+        client.afterFork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_afterFork)
+
+
 class DubboClient(object):
     def __init__(self, addrs, config, enable_heartbeat=False):
-        self.channels = []
         self._enable_heartbeat = enable_heartbeat
-        for addr in addrs:
-            self.channels.append(DubboChannel(addr))
 
+        poolConfig = {}
+        if config and KEY_POOL in config:
+            poolConfig.update(config[KEY_POOL])
+        if config and KEY_CONNECTIONS in config:
+            poolConfig.setdefault('maxConnections', config[KEY_CONNECTIONS])
         if config and KEY_HEARTBEAT in config:
             self.heartbeat = config[KEY_HEARTBEAT]
         else:
             self.heartbeat = DEFAULT_HEARTBEAT
 
-
-
-        # for long connection
+        heartbeat = self.heartbeat if enable_heartbeat else 0
+        flushBytes = config.get(KEY_FLUSH_BYTES, DEFAULT_FLUSH_BYTES) if config else DEFAULT_FLUSH_BYTES
+        flushDelay = config.get(KEY_FLUSH_DELAY, DEFAULT_FLUSH_DELAY) if config else DEFAULT_FLUSH_DELAY
+        limitConfig = config.get(KEY_LIMIT) if config else None
+        breakerConfig = config.get(KEY_BREAKER) if config else None
+        self.addrs = addrs
+        self.closed = False
+        self.channelConfig = dict(poolConfig=poolConfig, heartbeat=heartbeat, flushBytes=flushBytes,
+                                  flushDelay=flushDelay, limitConfig=limitConfig, breakerConfig=breakerConfig)
+        self.__createChannels()
+        _clients.add(self)
+
+    def __createChannels(self):
+        self.channels = []
+        for addr in self.addrs:
+            # an address is (host, port) or (host, port, weight)
+            weight = addr[2] if len(addr) > 2 else DEFAULT_WEIGHT
+            self.channels.append(DubboChannel(tuple(addr[:2]), weight=weight, **self.channelConfig))
+
+        # load balancer instances per (interface, method, strategy)
+        self.loadbalances = {}
+        self.clusters = {}
+        # result caches per (path, version, group, serialization, method),
+        # batchers per (method, pinned request id, method attachments)
+        self.caches = {}
+        self.batchers = {}
+
+        # for long connection: pin a proxy to the channel of its first call
         self.long_conn_records = {}
 
-    def close_channel(self, request_id):
-        channel = self.long_conn_records[request_id]
-        channel.close(request_id)
+    def afterFork(self):
+        '''
+            in a forked child, drop everything inherited from the parent.
+            connections are opened again when needed
+        '''
+        for channel in self.channels:
+            channel.detach()
+        self.__createChannels()
+
+    async def warmup(self):
+        await asyncio.gather(*[channel.warmup() for channel in self.channels])
+
+    def stats(self):
+        return dict(('%s:%s' % channel.addr, channel.stats()) for channel in self.channels)
+
+    def clusterStats(self):
+        stats = {}
+        for name, strategy in self.clusters.items():
+            value = strategy.stats()
+            if value is not None:
+                stats[name] = value
+        return stats
+
+    def getCache(self, invocation, config):
+        '''
+            the result cache of the method of invocation, created with config on first use
+        '''
+        key = _routingKey(invocation.attachments) + (invocation.getMethodName(),)
+        cache = self.caches.get(key)
+        if cache is None:
+            name = _routingName(invocation.attachments, invocation.getMethodName())
+            cache = self.caches[key] = _cache.ResultCache(name, **(config if isinstance(config, dict) else {}))
+        return cache
+
+    def cacheStats(self):
+        return dict((cache.name, cache.stats()) for cache in self.caches.values())
+
+    def batchStats(self):
+        return dict((batcher.name, batcher.stats()) for batcher in self.batchers.values())
 
-    async def invoke(self, rpcInvocation, request_id=None):
+    def close_channel(self, request_id):
+        # connections are shared by every caller of a channel, only forget the pin
+        self.long_conn_records.pop(request_id, None)
+        for key in [key for key in self.batchers if key[1] == request_id]:
+            # a window still open flushes on its own
+            del self.batchers[key]
+
+    async def close(self, timeout=DEFAULT_CLOSE_TIMEOUT):
+        '''
+            stops taking calls, waits up to timeout for the calls in flight,
+            then closes every connection. returns False if calls were cut off.
+            calls waiting in a batch window are sent, cache loads are finished
+        '''
+        self.closed = True
+        drains = [asyncio.ensure_future(batcher.drain()) for batcher in self.batchers.values()
+                  if batcher.pending or batcher.dispatching]
+        drains += [asyncio.ensure_future(cache.drain()) for cache in self.caches.values() if cache.loading]
+        drains += [asyncio.ensure_future(channel.drain()) for channel in self.channels if channel.active]
+        done = True
+        if drains:
+            _, pending = await asyncio.wait(drains, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            done = not pending
+            if pending:
+                print('Close with %d requests still in flight' % sum(channel.active for channel in self.channels))
+        for channel in self.channels:
+            channel.close()
+        self.long_conn_records = {}
+        return done
+
+    async def invoke(self, rpcInvocation, request_id=None, accepted=False):
+        '''
+            accepted calls were taken before close, they are sent while close waits for them
+        '''
+        if self.closed and not accepted:
+            raise protocol.DubboRejectedException('client is closed')
         request = protocol.DubboRequest()
         request.data = rpcInvocation
 
-        if request_id and self.long_conn_records.get(request_id):
-            # get registered channel
-            channel = self.long_conn_records[request_id]
-        else:
-            # set new channel
-            channel = self.__selectChannel(request)
-            self.long_conn_records[request_id] = channel
-
         timeout = _getRequestParam(request, KEY_TIMEOUT)
         withReturn = _getRequestParam(request, KEY_WITH_RETURN, True)
         is_async = _getRequestParam(request, KEY_ASYNC, False)
 
-        if not withReturn:
-            channel.send(request)
-            return
+        if request_id and self.long_conn_records.get(request_id) and self.long_conn_records[request_id].available():
+            # get registered channel
+            channel = self.long_conn_records[request_id]
+        elif request_id or not withReturn or is_async:
+            # set new channel
+            channel = self.select(request)
+            if request_id:
+                self.long_conn_records[request_id] = channel
+        else:
+            # failover, forking etc. only for plain calls, a pinned call stays on its channel
+            return (await self.__cluster(request).invoke(self, request, timeout))
 
-        if is_async:
+        if not withReturn or is_async:
             await channel.send(request)
             return
-        else:
-            if request_id:
-                # For long connection
-                if request_id in channel.sockets:
-                    ret = await channel.send_request(request, request_id=request_id, new_conn=False)
-                else:
-                    ret = await channel.send_request(request, request_id=request_id)
-            else:
-                # For short connection
-                ret = await channel.send_request(request)
-            return ret
 
-    def __selectChannel(self, request):
-        index = random.randint(0, len(self.channels) - 1)
-        return self.channels[index]
+        return (await self.call(channel, request, timeout))
+
+    def select(self, request, excluded=None):
+        '''
+            a channel for the request, avoiding the excluded ones while others are left
+        '''
+        invocation = request.data
+        name = _getRequestParam(request, KEY_LOADBALANCE, DEFAULT_LOADBALANCE)
+        key = (_getRequestParam(request, KEY_PATH), invocation.getMethodName(), name)
+        balancer = self.loadbalances.get(key)
+        if balancer is None:
+            balancer = self.loadbalances[key] = loadbalance.createLoadBalance(name)
+        # ejected providers are skipped, unless every provider is ejected
+        channels = [channel for channel in self.channels if channel.available()] or self.channels
+        if excluded:
+            channels = [channel for channel in channels if channel not in excluded] or channels
+        return balancer.select(channels, invocation)
+
+    async def call(self, channel, request, timeout):
+        actives = _getRequestParam(request, KEY_ACTIVES, 0)
+        return (await channel.send_request(request, timeout, actives))
+
+    def __cluster(self, request):
+        name = _getRequestParam(request, KEY_CLUSTER, DEFAULT_CLUSTER)
+        strategy = self.clusters.get(name)
+        if strategy is None:
+            strategy = self.clusters[name] = cluster.createCluster(name)
+        return strategy
+
+
+class InvokeResult(object):
+    '''
+        outcome of one call of ServiceProxy.invoke_many
+    '''
+    def __init__(self, index, args, value=None, exception=None):
+        self.index = index
+        self.args = args
+        self.value = value
+        self.exception = exception
+
+    @property
+    def ok(self):
+        return self.exception is None
+
+    def __str__(self):
+        return 'InvokeResult :' + str(self.__dict__)
 
 
 class ServiceProxy(object):
@@ -92,6 +254,9 @@ class ServiceProxy(object):
         self.classInfo = classInfo
         self.attachments = attachments
         self.long_conn = False
+        self.request_id = None
+        # method name (and argument types for overloads) -> (name, parameter descriptor)
+        self.resolved = {}
         if KEY_METHOD in attachments:
             self.methodConfig = attachments[KEY_METHOD]
             del attachments[KEY_METHOD]
@@ -107,7 +272,6 @@ class ServiceProxy(object):
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.client.close_channel(self.request_id)
-        del self.client.long_conn_records[self.request_id]
         self.long_conn = False
 
     def _updateConfig(self, config):
@@ -125,12 +289,139 @@ class ServiceProxy(object):
                 else:
                     self.methodConfig[methodName].update(methodConfig)
 
-    async def invoke(self, name, args):
+    async def invoke(self, name, args, paramTypes=None):
+        '''
+            paramTypes, the java parameter types as names like 'java.lang.Long', only
+            matter for a generic proxy. they default to the parameterTypes method config
+        '''
+        if self.client.closed:
+            raise protocol.DubboRejectedException('client is closed')
+        name = self.__resolveName(name)
+        attachments = self.__methodAttachments(name)
+        if KEY_BATCH in attachments and len(args) == 1:
+            return (await self.__batcher(name, attachments).get(args[0]))
+        invocation = self.__invocation(name, args, attachments, paramTypes)
+        return (await self.__invoke(invocation))
+
+    async def invoke_many(self, name, argsIterable, concurrency=DEFAULT_BATCH_CONCURRENCY, ordered=True):
+        '''
+            call method name once for every args tuple, with at most concurrency calls in flight.
+            yields an InvokeResult per call, in input order or, if ordered is False, as they complete.
+            a failed call is reported in its InvokeResult and does not stop the others
+        '''
+        attachments = None
+        methodName = None
+        pending = set()
+        # results finished ahead of an earlier call, held back while ordered
+        finished = {}
+        nextIndex = 0
+        argsIterator = iter(enumerate(argsIterable))
+
+        async def call(index, args):
+            result = InvokeResult(index, args)
+            try:
+                if self.client.closed:
+                    raise protocol.DubboRejectedException('client is closed')
+                # an item that is not an args sequence fails alone
+                args = result.args = tuple(args)
+                invocation = self.__invocation(methodName, args, attachments)
+                result.value = await self.__invoke(invocation)
+            except Exception as e:
+                result.exception = e
+            return result
+
+        def fill():
+            while len(pending) < concurrency:
+                try:
+                    index, args = next(argsIterator)
+                except StopIteration:
+                    return
+                pending.add(asyncio.ensure_future(call(index, args)))
+
+        try:
+            methodName = self.__resolveName(name)
+            attachments = self.__methodAttachments(methodName)
+            fill()
+            while pending:
+                # every completion frees a slot, also behind a slow call at the head
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                pending.difference_update(done)
+                fill()
+                for task in done:
+                    result = task.result()
+                    if ordered:
+                        finished[result.index] = result
+                    else:
+                        yield result
+                while nextIndex in finished:
+                    yield finished.pop(nextIndex)
+                    nextIndex += 1
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def __batcher(self, name, attachments):
+        # proxies share a batcher only when their calls would be the same: same
+        # attachments, version and group among them, and the same pinned connection
+        key = (name, self.request_id, _cache._freeze(attachments))
+        batcher = self.client.batchers.get(key)
+        if batcher is None:
+            config = dict(attachments[KEY_BATCH])
+            batchName = self.__resolveName(config.pop(KEY_METHOD))
+
+            async def load(keys):
+                attachments = self.__methodAttachments(batchName)
+                attachments.pop(KEY_BATCH, None)
+                return (await self.__invoke(self.__invocation(batchName, (keys,), attachments)))
+
+            batcher = self.client.batchers[key] = _batch.Batcher(_routingName(attachments, name), load, **config)
+        return batcher
+
+    async def __invoke(self, invocation):
+        attachments = invocation.attachments
+        cacheConfig = attachments.get(KEY_CACHE)
+        if cacheConfig and attachments.get(KEY_WITH_RETURN, True) and not attachments.get(KEY_ASYNC, False):
+            cache = self.client.getCache(invocation, cacheConfig)
+            return (await cache.get(invocation.params, lambda: self.__send(invocation)))
+        return (await self.__send(invocation))
+
+    async def __send(self, invocation):
+        # the proxy entry points rejected the call if the client was closed already
+        if not self.request_id in self.client.long_conn_records:
+            return (await self.client.invoke(invocation, accepted=True))
+        else:
+            return (await self.client.invoke(invocation, request_id=self.request_id, accepted=True))
+
+    def __invocation(self, name, args, attachments, paramTypes=None):
+        if self.classInfo is None:
+            # $invoke(method, parameterTypes, args). without parameter types the
+            # provider finds the method by its name, which must not be overloaded
+            if paramTypes is None:
+                paramTypes = attachments.get(KEY_PARAMETER_TYPES)
+            return protocol.RpcInvocation(protocol.GENERIC_METHOD_NAME, protocol.GENERIC_PARAMETER_TYPES,
+                                          [name.decode('utf-8'), paramTypes, list(args)], attachments)
+        name, paramType = self.__resolveMethod(name, args)
+        return protocol.RpcInvocation(name, paramType, args, attachments)
+
+    def __resolveName(self, name):
         if type(name) == str:
             name = name.encode('utf-8')
+        if self.classInfo is None:
+            return name
         if not name in self.classInfo.methodMap:
             raise KeyError('interface ' + self.classInfo.thisClass + ' has no method name ' + str(name))
+        return name
+
+    def __resolveMethod(self, name, args):
+        name = self.__resolveName(name)
         methods = self.classInfo.methodMap[name]
+        if len(methods) > 1:
+            key = (name, tuple(type(arg) for arg in args))
+        else:
+            key = name
+        if key in self.resolved:
+            return self.resolved[key]
+
         if len(methods) > 1:
             method = self.__guessMethod(methods, args)
             if method == None:
@@ -146,16 +437,16 @@ class ServiceProxy(object):
         else:
             method = methods[0]
 
-        paramType = self.__getParamType(method)
+        self.resolved[key] = (name, self.__getParamType(method))
+        return self.resolved[key]
 
+    def __methodAttachments(self, name):
         attachments = self.attachments.copy()
-        if name in self.methodConfig:
-            attachments.update(self.methodConfig[name])
-        invocation = protocol.RpcInvocation(name, paramType, args, attachments)
-        if not self.request_id in self.client.long_conn_records:
-            return (await self.client.invoke(invocation))
-        else:
-            return (await self.client.invoke(invocation, request_id=self.request_id))
+        # method config may be keyed by str or bytes
+        for key in (name.decode('utf-8'), name):
+            if key in self.methodConfig:
+                attachments.update(self.methodConfig[key])
+        return attachments
 
     def __guessMethod(self, methods, args):
         for method in methods:
@@ -209,6 +500,11 @@ def _getAndDelConfigParam(config, key, default=None):
         return default
 
 
+# consumer side settings, never sent to the provider as attachments
+_CLIENT_CONFIG_KEYS = (KEY_REFERENCE, KEY_POOL, KEY_FLUSH_BYTES, KEY_FLUSH_DELAY, KEY_LIMIT, KEY_BREAKER,
+                      KEY_WARMUP)
+
+
 class Dubbo(object):
     def __init__(self, addrs, config=None, enable_heartbeat=False):
         if config:
@@ -218,33 +514,48 @@ class Dubbo(object):
         self.config = config
 
         classpath = _getAndDelConfigParam(config, KEY_CLASSPATH)
-        self.javaClassLoader = java.JavaClassLoader(classpath)
+        if classpath or os.getenv('PD_CLASSPATH'):
+            self.javaClassLoader = java.JavaClassLoader(classpath)
+        else:
+            # no jars, every proxy makes generic calls
+            self.javaClassLoader = None
+        self.descriptors = {}
+        descriptor = _getAndDelConfigParam(config, KEY_DESCRIPTOR)
+        if descriptor:
+            with open(descriptor) as f:
+                self.descriptors = json.load(f)
 
         owner = _getAndDelConfigParam(config, KEY_DUBBO_OWNER, DEFAULT_DUBBO_OWNER)
         customer = _getAndDelConfigParam(config, KEY_DUBBO_CUSTOMER, DEFAULT_DUBBO_CUSTOMER)
         self.attachments = {KEY_OWNER: owner, KEY_CUSTOMER: customer}
 
         for key, value in self.config.items():
-            if key == KEY_REFERENCE:
+            if key in _CLIENT_CONFIG_KEYS:
                 continue
             self.attachments[key] = value
 
         if KEY_REFERENCE not in self.config:
             self.config[KEY_REFERENCE] = {}
 
-        self.client = DubboClient(addrs, self.config)
+        self.client = DubboClient(addrs, self.config, enable_heartbeat)
 
     def getObject(self, name):
         if type(name) == bytes:
             name = name.decode()
+        if self.javaClassLoader is None:
+            return _model.Object(name)
         return self.javaClassLoader.createObject(name)
 
     def getProxy(self, interface, **args):
         if type(interface) == str:
             interface = interface.encode()
-        classInfo = self.javaClassLoader.findClassInfo(interface)
-        if classInfo == None:
-            return None
+        generic = self.javaClassLoader is None or args.get(KEY_GENERIC)
+        if generic:
+            classInfo = None
+        else:
+            classInfo = self.javaClassLoader.findClassInfo(interface)
+            if classInfo == None:
+                return None
         attachments = self.attachments.copy()
         attachments[KEY_PATH] = interface
         attachments[KEY_INTERFACE] = interface
@@ -256,18 +567,58 @@ class Dubbo(object):
             for key, value in args.items():
                 attachments[key] = value
 
+        if generic:
+            attachments[KEY_GENERIC] = 'true'
+            self.__addDescriptor(interface, attachments)
+
         self.__checkAttachments(attachments)
 
         return ServiceProxy(self.client, classInfo, attachments)
 
     def createConstObjectFromClass(self, className):
+        if self.javaClassLoader is None:
+            raise EnvironmentError('java classpath is empty')
         return self.javaClassLoader.createConstObject(className)
 
+    def __addDescriptor(self, interface, attachments):
+        # parameter types from the descriptor file, unless the method config has them
+        methods = self.descriptors.get(interface.decode('utf-8'))
+        if not methods:
+            return
+        methodConfig = dict((name, dict(config)) for name, config in attachments.get(KEY_METHOD, {}).items())
+        for name, paramTypes in methods.items():
+            config = methodConfig.setdefault(name, {})
+            if KEY_PARAMETER_TYPES not in config:
+                config[KEY_PARAMETER_TYPES] = paramTypes
+        attachments[KEY_METHOD] = methodConfig
+
     def __checkAttachments(self, attachments):
         if KEY_TIMEOUT not in attachments:
             attachments[KEY_TIMEOUT] = DEFAULT_TIMEOUT
         if KEY_VERSION not in attachments:
             attachments[KEY_VERSION] = DEFAULT_SERVICE_VERSION
 
-    def close(self):
-        print('Executors done!')
+    async def warmup(self):
+        '''
+            opens the connections to every provider ahead of the first call
+        '''
+        await self.client.warmup()
+
+    def stats(self):
+        return self.client.stats()
+
+    def clusterStats(self):
+        return self.client.clusterStats()
+
+    def cacheStats(self):
+        return self.client.cacheStats()
+
+    def batchStats(self):
+        return self.client.batchStats()
+
+    async def close(self, timeout=DEFAULT_CLOSE_TIMEOUT):
+        '''
+            graceful shutdown: new calls are rejected, calls in flight get up to
+            timeout seconds to finish, then the connections are flushed and closed
+        '''
+        return (await self.client.close(timeout))
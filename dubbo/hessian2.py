@@ -10,8 +10,6 @@ from ._model import *
 from ._utils import printByteStr
 from . import enhancetypes
 
-_Hessian2Input__debug = False
-
 
 class ClassDef(object) :
     def __init__(self, type, fieldNames) :
@@ -45,6 +43,10 @@ class Hessian2Output(object) :
     def getLength(self) :
         return len(self.output.getvalue())
 
+    def writeRaw(self, value) :
+        # bytes encoded elsewhere, they must not refer to objects of this stream
+        self.output.write(value)
+
     def __write(self, value):
         if type(value) == str:
             value = value.encode()
@@ -92,7 +94,7 @@ class Hessian2Output(object) :
             self.__writeByte(value & 0xff)
         elif -262144 <= value <= 262143:
             self.__writeByte(0xd4 + (value >> 16))
-            self.__pack('>H', (value >> 8))
+            self.__pack('>H', value & 0xFFFF)
         else :
             self.__write('I')
             self.__pack('>i', value)
@@ -139,25 +141,25 @@ class Hessian2Output(object) :
                ::= x5e b1 b0
                 -32768.0 <= value <= 32767.0, value = (double)(256 * b1 + b0)
                ::= x5f b3 b2 b1 b0
-                32bit float
+                value = 0.001 * (32bit int)
         '''
         intValue = int(value)
-        if intValue == value :
+        if intValue == value and -32768 <= intValue <= 32767 :
             if intValue == 0 :
                 self.__write('\x5b')
             elif intValue == 1 :
                 self.__write('\x5c')
             elif -128 <= intValue <= 127 :
                 self.__write('\x5d')
-                self.__writeByte(value & 0xff)
-            elif -32768 <= value <= 32767 :
+                self.__pack('>b', intValue)
+            else :
                 self.__write('\x5e')
-                self.__pack('>h', value)
+                self.__pack('>h', intValue)
             return
         mills = int(value * 1000);
-        if (0.001 * mills) == value :
+        if (0.001 * mills) == value and -0x80000000 <= mills <= 0x7fffffff :
             self.__write('\x5f')
-            self.__pack('>f', value)
+            self.__pack('>i', mills)
         else :
             self.__write('D')
             self.__pack('>d', value)
@@ -330,7 +332,7 @@ class Hessian2Output(object) :
             self.__writeByte(0x78 + len(value))
         else :
             self.__write('\x58')
-            __encodeInt(len(value))
+            self.__encodeInt(len(value))
         for element in value :
             self.__mWriteObject(element)
 
@@ -428,329 +430,338 @@ def decodeFor(codes) :
         return f
     return register
 
-    
+_BYTE = struct.Struct('>b')
+_SHORT = struct.Struct('>h')
+_USHORT = struct.Struct('>H')
+_INT = struct.Struct('>i')
+_LONG = struct.Struct('>q')
+_DOUBLE = struct.Struct('>d')
+
+def _decodeUTF8(value) :
+    try :
+        return value.decode('utf-8')
+    except UnicodeDecodeError :
+        # java writes a character out of the BMP as two 3 byte surrogates
+        return value.decode('utf-8', 'surrogatepass').encode('utf-16', 'surrogatepass').decode('utf-16')
+
 
 class Hessian2Input(object) :
-    def __init__(self, bytes) :
-        self.input = BytesIO(bytes)
+    '''
+        decoder of a hessian2 byte string, it reads at an offset into the bytes.
+        the end of the data is only detected by the IndexError or struct.error
+        it causes, readObject turns them into ValueError
+    '''
+    def __init__(self, data) :
+        if not isinstance(data, bytes) :
+            data = bytes(data)
+        self.data = data
+        self.offset = 0
         self.types = []
         self.classDefs = []
         self.refs = []
-    def readObject(self) :
-        #pdb.set_trace()
-        return self.__mReadObject(self.__readByte())
 
-    def __readByte(self) :
-        c = self.input.read(1)
-        if c == '' :
+    def readObject(self) :
+        try :
+            return self._read(self._readByte())
+        except (IndexError, struct.error) :
             raise ValueError('End Of Byte String')
-        return ord(c)
 
-    def __read(self, num = 1) :
-        c = self.input.read(num)
-        if len(c) < num :
-            raise ValueError('End Of Byte String')
-        return c
-
-    def __mReadObject(self, code) :
-        while True :
-            if code < 0 or code > 255 :
-                raise ValueError('code %x is unexpected when read object')
-            decoder = DECODERS[code]
-            if decoder == None :
-                raise ValueError('code %x is not support')
-            result = decoder(self, code)
-            if result == None and code == ord('C') :
-                code = self.__readByte()
-                continue
-            return result
-
-    @decodeFor((ord('N'),))
-    def __decodeNull(self, code) :
-        if __debug :
-            print('read None')
-        return None
+    def _readByte(self) :
+        offset = self.offset
+        self.offset = offset + 1
+        return self.data[offset]
+
+    def _readBytes(self, num) :
+        offset = self.offset
+        end = offset + num
+        if end > len(self.data) :
+            raise IndexError(end)
+        self.offset = end
+        return self.data[offset:end]
+
+    def _unpack(self, codec) :
+        offset = self.offset
+        self.offset = offset + codec.size
+        return codec.unpack_from(self.data, offset)[0]
+
+    def _read(self, code) :
+        # the most frequent tags without a lookup: compact int, short string, null, object
+        if 0x80 <= code <= 0xbf :
+            return code - 0x90
+        if code <= 0x1f :
+            offset = self.offset
+            end = offset + code
+            value = self.data[offset:end]
+            if value.isascii() and len(value) == code :
+                self.offset = end
+                return value.decode('ascii')
+            return _decodeUTF8(self._readUTF(code))
+        if code == 0x4e :
+            return None
+        if 0x60 <= code <= 0x6f :
+            return self._readInstance(code - 0x60)
+        if code == 0x43 :
+            self._readClassDef()
+            return self._read(self._readByte())
+        decoder = DECODERS[code]
+        if decoder is None :
+            raise ValueError('code 0x%x is not support' % code)
+        return decoder(self, code)
+
+    def _readUTF(self, length) :
+        '''
+            the utf-8 bytes of the next length characters
+        '''
+        data = self.data
+        offset = self.offset
+        end = offset + length
+        value = data[offset:end]
+        if not value.isascii() :
+            end = offset
+            while length > 0 :
+                c = data[end]
+                if c < 0x80 :
+                    end += 1
+                elif (c & 0xe0) == 0xc0 :
+                    end += 2
+                elif (c & 0xf0) == 0xe0 :
+                    end += 3
+                elif (c & 0xf8) == 0xf0 :
+                    end += 4
+                else :
+                    end += 1
+                length -= 1
+            value = data[offset:end]
+        if end > len(data) :
+            raise IndexError(end)
+        self.offset = end
+        return value
 
     @decodeFor((ord('F'), ord('T')))
-    def __decodeBoolean(self, code) :
-        if __debug :
-            print('read boolean :', code == 0x54)
+    def _readBoolean(self, code) :
         return code == 0x54
 
     @decodeFor(((0x80, 0xbf), (0xc0, 0xcf), (0xd0, 0xd7), ord('I')))
-    def __decodeInt(self, code) :
-        result = 0
+    def _readInt(self, code) :
         if 0x80 <= code <= 0xbf :
-            result = code - 0x90
-        elif 0xc0 <= code <= 0xcf :
-            i = (code - 0xc8) << 8
-            i |= self.__readByte()
-            result = i
-        elif 0xd0 <= code <= 0xd7 :
-            i = (code - 0xd4) << 16
-            i |= self.__readByte() << 8
-            i |= self.__readByte()
-            result = i
-        else :
-            result = struct.unpack('>i', self.__read(4))[0]
-        if __debug :
-            print('read int :', result)
-        return result
-            
+            return code - 0x90
+        if 0xc0 <= code <= 0xcf :
+            return ((code - 0xc8) << 8) | self._readByte()
+        if 0xd0 <= code <= 0xd7 :
+            return ((code - 0xd4) << 16) | self._unpack(_USHORT)
+        if code == 0x49 :
+            return self._unpack(_INT)
+        raise ValueError('code 0x%x is unexpected when read int' % code)
+
     @decodeFor(((0xd8, 0xef), (0xf0, 0xff), (0x38, 0x3f), 0x59, ord('L')))
-    def __decodeLong(self, code) :
-        result = 0
+    def _readLong(self, code) :
         if 0xd8 <= code <= 0xef :
-            result = code - 0xe0
-        elif 0xf0 <= code <= 0xff :
-            result = ((code - 0xf8) << 8) | self.__readByte()
-        elif 0x38 <= code <= 0x3f :
-            i = (code - 0x3c) << 16
-            i |= self.__readByte() << 8
-            i |= self.__readByte()
-            result = i
-        elif code == 0x59 :
-            result = struct.unpack('>i', self.__read(4))[0]
-        else :
-            result = struct.unpack('>q', self.__read(8))[0]
-        if __debug :
-            print('read long :', result)
-        return result
+            return code - 0xe0
+        if 0xf0 <= code :
+            return ((code - 0xf8) << 8) | self._readByte()
+        if 0x38 <= code <= 0x3f :
+            return ((code - 0x3c) << 16) | self._unpack(_USHORT)
+        if code == 0x59 :
+            return self._unpack(_INT)
+        return self._unpack(_LONG)
 
     @decodeFor((0x5b, 0x5c, 0x5d, 0x5e, 0x5f, ord('D')))
-    def __decodeFloat(self, code) :
-        result = 0.0
+    def _readDouble(self, code) :
         if code == 0x5b :
-            result = 0.0
-        elif code == 0x5c :
-            result = 1.0
-        elif code == 0x5d :
-            result = float(struct.unpack('>b', self.__read(1))[0])
-        elif code == 0x5e :
-            result = float(struct.unpack('>h', self.__read(2))[0])
-        elif code == 0x5f :
-            result = struct.unpack('>f', self.__read(4))[0]
-        else :
-            result = struct.unpack('>d', self.__read(8))[0]
-        if __debug :
-            print('read float :', result)
-        return result
+            return 0.0
+        if code == 0x5c :
+            return 1.0
+        if code == 0x5d :
+            return float(self._unpack(_BYTE))
+        if code == 0x5e :
+            return float(self._unpack(_SHORT))
+        offset = self.offset
+        if code == 0x5f :
+            # thousandths as a 32 bit int
+            self.offset = offset + 4
+            return 0.001 * _INT.unpack_from(self.data, offset)[0]
+        self.offset = offset + 8
+        return _DOUBLE.unpack_from(self.data, offset)[0]
 
     @decodeFor((0x4a, 0x4b))
-    def __decodeDate(self, code) :
-        result = None
+    def _readDate(self, code) :
         if code == 0x4a :
-            timei = struct.unpack('>q', self.__read(8))[0]
+            timei = self._unpack(_LONG)
             ts = time.localtime(timei/1000)
             milliseconds = timei % 1000
-            result = datetime.datetime(ts.tm_year, ts.tm_mon, ts.tm_mday, ts.tm_hour, ts.tm_min, ts.tm_sec, milliseconds * 1000)
-        else :
-            timei = struct.unpack('>i', self.__read(4))[0]
-            ts = time.localtime(timei * 60)
-            result = datetime.datetime(ts.tm_year, ts.tm_mon, ts.tm_mday, ts.tm_hour, ts.tm_min)
-        if __debug :
-            print('read date :', result)
-        return result
+            return datetime.datetime(ts.tm_year, ts.tm_mon, ts.tm_mday, ts.tm_hour, ts.tm_min, ts.tm_sec, milliseconds * 1000)
+        timei = self._unpack(_INT)
+        ts = time.localtime(timei * 60)
+        return datetime.datetime(ts.tm_year, ts.tm_mon, ts.tm_mday, ts.tm_hour, ts.tm_min)
 
-    def __readUTF(self, output, length) :
-        while length > 0 :
-            c = self.__readByte()
-            #output.write(chr(c))
-            output.write(c.to_bytes(1, 'big'))
-            if c < 0x80 :
-                pass
-            elif (c & 0xe0) == 0xc0 :
-                output.write(self.__read(1))
-            elif (c & 0xf0) == 0xe0 :
-                output.write(self.__read(2))
-            elif (c & 0xf8) == 0xf0 :
-                output.write(self.__read(3))
-            length -= 1
-        
     @decodeFor((0x52, ord('S'), (0x00, 0x1f), (0x30, 0x33)))
-    def __decodeString(self, code) :
-        buf = BytesIO()
+    def _readString(self, code) :
+        chunks = []
         while code == 0x52 :
-            length = struct.unpack('>H', self.__read(2))[0]
-            self.__readUTF(buf, length)
-            code = self.__readByte()
-
-        length = 0
-        if code == ord('S') :
-            length = struct.unpack('>H', self.__read(2))[0]
-        elif 0x00 <= code <= 0x1f :
+            chunks.append(self._readUTF(self._unpack(_USHORT)))
+            code = self._readByte()
+
+        if code == 0x53 :
+            length = self._unpack(_USHORT)
+        elif code <= 0x1f :
             length = code
+        elif 0x30 <= code <= 0x33 :
+            length = (code - 0x30) << 8 | self._readByte()
         else :
-            length = (code - 0x30) << 8 | self.__readByte()
-        
-        self.__readUTF(buf, length)
-        result = buf.getvalue().decode('utf-8')
-        if __debug :
-            print('read string :', result)
-        return result
-
-    def __decodeType(self) :
-        code = self.__readByte()
-        if code == 0x52                     \
-            or code == ord('S')             \
-            or (0x00 <= code <= 0x1f)       \
-            or (0x30 <= code <= 0x33) :
-
-            type = self.__decodeString(code)
+            raise ValueError('code 0x%x is unexpected when read string' % code)
+        chunks.append(self._readUTF(length))
+        # a surrogate pair may be split over two chunks, decode them together
+        return _decodeUTF8(b''.join(chunks))
+
+    def _readType(self) :
+        code = self._readByte()
+        if code == 0x52 or code == 0x53 or code <= 0x1f or 0x30 <= code <= 0x33 :
+            type = self._readString(code)
             if type == '' :
                 raise ValueError('type string is empty')
             self.types.append(type)
-            if __debug :
-                print('read type :', type)
             return type
-        elif code == ord('I')               \
-            or (0x80 <= code <= 0xbf)       \
-            or (0xc0 <= code <= 0xcf)       \
-            or (0xd0 <= code <= 0xd7) :
-            
-            typeId = self.__decodeInt(code)
+        if code == 0x49 or 0x80 <= code <= 0xd7 :
+            typeId = self._readInt(code)
             if typeId < 0 or typeId >= len(self.types) :
                 raise ValueError('type id %d undefined' % (typeId,))
-            if __debug :
-                print('read type ref :', typeId, self.types[typeId])
             return self.types[typeId]
-        else :
-            raise ValueError('code %x is unexpected when decode type')
+        raise ValueError('code 0x%x is unexpected when read type' % code)
 
     @decodeFor((0x55, 0x57))
-    def __decodeList(self, code) :
+    def _readList(self, code) :
         if code == 0x55 :
-            self.__decodeType()
-        
+            self._readType()
+
         result = []
-        c = self.__readByte()
-        while c != ord('Z') :
-            result.append(self.__mReadObject(c))
-            c = self.__readByte()
-    
         self.refs.append(result)
-        if __debug :
-            print('read list :', result)
+        read = self._read
+        c = self._readByte()
+        while c != 0x5a :
+            result.append(read(c))
+            c = self._readByte()
         return result
 
     @decodeFor((ord('V'), 0x58, (0x70, 0x77), (0x78, 0x7f)))
-    def __decodeTuple(self, code) :
-        result = []
-
-        if code == ord('V') or (0x70 <= code <= 0x77) :
-            self.__decodeType()
+    def _readTuple(self, code) :
+        if code == 0x56 or 0x70 <= code <= 0x77 :
+            self._readType()
 
-        length = 0
         if 0x70 <= code <= 0x77 :
             length = code - 0x70
         elif 0x78 <= code <= 0x7f :
             length = code - 0x78
         else :
-            length = self.__decodeInt(self.__readByte())
-        
-        while length > 0 :
-            result.append(self.__mReadObject(self.__readByte()))
-            length -= 1
+            length = self._readInt(self._readByte())
 
+        # the tuple only exists once its elements are read, hold its ref id meanwhile
+        refId = len(self.refs)
+        self.refs.append(None)
+        read = self._read
+        data = self.data
+        result = []
+        for i in range(length) :
+            offset = self.offset
+            self.offset = offset + 1
+            result.append(read(data[offset]))
         result = tuple(result)
-        self.refs.append(result)
-        if __debug :
-            print('read tuple :', result)
+        self.refs[refId] = result
         return result
 
     @decodeFor((ord('H'), ord('M')))
-    def __decodeDict(self, code) :
-        result = {}
-
-        if code == ord('M') :
-            self.__decodeType()
-
-        c = self.__readByte()
-        while c != ord('Z') :
-            key = self.__mReadObject(c)
-            value = self.__mReadObject(self.__readByte())
-            result[key] = value
-            c = self.__readByte()
+    def _readDict(self, code) :
+        if code == 0x4d :
+            self._readType()
 
+        result = {}
         self.refs.append(result)
-        if __debug :
-            print('read dict :', result)
+        read = self._read
+        readByte = self._readByte
+        c = readByte()
+        while c != 0x5a :
+            key = read(c)
+            result[key] = read(readByte())
+            c = readByte()
         return result
 
     @decodeFor((0x41, ord('B'), (0x20, 0x2f), (0x34, 0x37)))
-    def __decodeBinary(self, code) :
-        result = Binary(None)
+    def _readBinary(self, code) :
+        chunks = []
         while code == 0x41 :
-            length = struct.unpack('>H', self.__read(2))[0]
-            result += Binary(self.__read(length))
-            code = self.__readByte()
-        
-        length = 0
-        if code == ord('B') :
-            length = struct.unpack('>H', self.__read(2))[0]
+            chunks.append(self._readBytes(self._unpack(_USHORT)))
+            code = self._readByte()
+
+        if code == 0x42 :
+            length = self._unpack(_USHORT)
         elif 0x20 <= code <= 0x2f :
             length = code - 0x20
         else :
-            length = ((code - 0x34) << 8) | self.__readByte()
-
+            length = ((code - 0x34) << 8) | self._readByte()
         if length > 0 :
-            result += Binary(self.__read(length))
-        
-        if __debug :
-            print('read Binary :', result)
-        return result
-
-    @decodeFor((ord('C'),))
-    def __decodeClassDef(self, code) :
-        type = self.__decodeString(self.__readByte())
-        length = self.__decodeInt(self.__readByte())
-
-        fieldNames = []
-        while length > 0 :
-            fieldNames.append(self.__decodeString(self.__readByte()))
-            length -= 1
-        self.classDefs.append(ClassDef(type, fieldNames))
-
-        if __debug :
-            print('read ClassDef :', ClassDef(type, fieldNames))
-        return None
-
-    @decodeFor((ord('O'), (0x60, 0x6f)))
-    def __decodeObject(self, code) :
-        defId = -1
-        if code == ord('O') :
-            defId = self.__decodeInt(self.__readByte())
-        else :
-            defId = code - 0x60
+            chunks.append(self._readBytes(length))
+        return Binary(b''.join(chunks) if chunks else None)
+
+    def _readClassDef(self) :
+        type = self._readString(self._readByte())
+        length = self._readInt(self._readByte())
+        fieldNames = [self._readString(self._readByte()) for i in range(length)]
+        classDef = ClassDef(type, fieldNames)
+        self.classDefs.append(classDef)
+        return classDef
+
+    @decodeFor((ord('O'),))
+    def _readObject(self, code) :
+        return self._readInstance(self._readInt(self._readByte()))
+
+    def _readInstance(self, defId) :
         if defId >= len(self.classDefs) :
             raise ValueError('classDef id %d is undefined' % (defId,))
-        
-        result = {}
         cDef = self.classDefs[defId]
-        if __debug :
-            print('start read Object : defId =', defId, 'type =', cDef.type)
-        for key in cDef.fieldNames :
-            result[key] = self.__mReadObject(self.__readByte())
-            if __debug :
-                print('read Object field :', key, ' =', result[key])
-        
+        result = Object(cDef.type)
         self.refs.append(result)
-
-        if __debug :
-            print('read Object :', result)
-        return Object(cDef.type, result)
+        fields = result.__dict__
+        read = self._read
+        data = self.data
+        for key in cDef.fieldNames :
+            # _readByte inlined, this loop decodes most of a response
+            offset = self.offset
+            self.offset = offset + 1
+            fields[key] = read(data[offset])
+        return result
 
     @decodeFor((0x51,))
-    def __decodeRef(self, code) :
-        refId = self.__decodeInt(self.__readByte())
+    def _readRef(self, code) :
+        refId = self._readInt(self._readByte())
         if refId >= len(self.refs) :
             return None
             #raise ValueError('ref id %d is undefined' % (refId,))
-
-        if __debug :
-            print('read ref :', refId)
         return self.refs[refId]
 
+
+class DebugHessian2Input(Hessian2Input) :
+    '''
+        Hessian2Input printing every value it reads with its offset and tag,
+        for tracing a stream that does not decode as expected
+    '''
+    def __init__(self, data) :
+        Hessian2Input.__init__(self, data)
+        self.depth = 0
+
+    def _read(self, code) :
+        offset = self.offset - 1
+        self.depth += 1
+        try :
+            result = Hessian2Input._read(self, code)
+        finally :
+            self.depth -= 1
+        print('%sread %s at %d (0x%02x) : %s' % ('  ' * self.depth, type(result).__name__, offset, code, result))
+        return result
+
+    def _readClassDef(self) :
+        classDef = Hessian2Input._readClassDef(self)
+        print('%sread %s' % ('  ' * self.depth, classDef))
+        return classDef
+
 if __name__ == '__main__' :
     a = {'b':1, 'a':'cfdfdfd', 'c':[1, 2, 3], 'd':u'你好'}
     print(a)
@@ -836,13 +847,11 @@ if __name__ == '__main__' :
     52 51 9b f8 78 4e 4e 4e 4e
     '''
 
-    data = data.split()
-    data = [chr(eval('0x' + num)) for num in data]
-    data = ''.join(data)
+    data = bytes(int(num, 16) for num in data.split())
     print(len(data))
     printByteStr(data)
 
-    input = Hessian2Input(data)
+    input = DebugHessian2Input(data)
 
     print(input.readObject())
 
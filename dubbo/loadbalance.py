@@ -0,0 +1,174 @@
+import bisect
+import hashlib
+import math
+import random
+import struct
+import time
+
+from . import _model
+from .constants import *
+
+
+class PeakEwma(object):
+    '''
+        exponentially weighted moving average of latency that jumps to any
+        higher sample at once and decays towards lower ones over decayTime seconds
+    '''
+    def __init__(self, decayTime=DEFAULT_EWMA_DECAY):
+        self.decayTime = decayTime
+        self.value = 0.0
+        self.stamp = time.monotonic()
+
+    def observe(self, rtt):
+        now = time.monotonic()
+        if rtt > self.value:
+            self.value = rtt
+        else:
+            w = math.exp(-(now - self.stamp) / self.decayTime)
+            self.value = self.value * w + rtt * (1 - w)
+        self.stamp = now
+
+    def get(self):
+        # an idle channel slowly looks faster again, so it gets probed
+        return self.value * math.exp(-(time.monotonic() - self.stamp) / self.decayTime)
+
+
+class LoadBalance(object):
+    '''
+        picks one of the channels of a reference for an invocation.
+        an instance is kept per interface and method, so it may keep state
+    '''
+    def select(self, channels, invocation):
+        raise NotImplementedError
+
+
+class RandomLoadBalance(LoadBalance):
+    def select(self, channels, invocation):
+        return _weightedChoice(channels)
+
+
+class RoundRobinLoadBalance(LoadBalance):
+    '''
+        smooth weighted round robin, spreads the picks of heavy channels
+        instead of sending them in bursts
+    '''
+    def __init__(self):
+        self.current = {}
+
+    def select(self, channels, invocation):
+        total = 0
+        best = None
+        current = {}
+        for channel in channels:
+            weight = channel.weight
+            value = self.current.get(channel, 0) + weight
+            current[channel] = value
+            total += weight
+            if best is None or value > current[best]:
+                best = channel
+        current[best] -= total
+        self.current = current
+        return best
+
+
+class LeastActiveLoadBalance(LoadBalance):
+    '''
+        the channel with the fewest requests in flight, weighted random among ties
+    '''
+    def select(self, channels, invocation):
+        least = min(channel.active for channel in channels)
+        return _weightedChoice([channel for channel in channels if channel.active == least])
+
+
+class PeakEwmaLoadBalance(LoadBalance):
+    '''
+        power of two choices on peak EWMA latency scaled by requests in flight
+    '''
+    def select(self, channels, invocation):
+        if len(channels) == 1:
+            return channels[0]
+        a, b = random.sample(channels, 2)
+        return a if self.__cost(a) <= self.__cost(b) else b
+
+    def __cost(self, channel):
+        latency = channel.latency.get()
+        if latency == 0 and channel.active:
+            # no sample yet, but busy
+            return DEFAULT_EWMA_PENALTY + channel.active
+        return latency * (channel.active + 1)
+
+
+class ConsistentHashLoadBalance(LoadBalance):
+    '''
+        the same arguments always go to the same channel while the channel set
+        is unchanged. the arguments hashed are given by the hashArguments config,
+        the first one by default
+    '''
+    def __init__(self, nodes=DEFAULT_HASH_NODES):
+        self.nodes = nodes
+        self.ringKey = None
+        self.hashes = []
+        self.channels = []
+
+    def select(self, channels, invocation):
+        ringKey = tuple(id(channel) for channel in channels)
+        if ringKey != self.ringKey:
+            self.__build(channels)
+            self.ringKey = ringKey
+
+        params = invocation.getArguments()
+        indexes = invocation.attachments.get(KEY_HASH_ARGUMENTS, DEFAULT_HASH_ARGUMENTS)
+        key = ','.join(_hashKey(params[i]) for i in indexes if i < len(params))
+        index = bisect.bisect(self.hashes, _hash(hashlib.md5(key.encode()).digest(), 0))
+        return self.channels[index % len(self.channels)]
+
+    def __build(self, channels):
+        ring = []
+        for channel in channels:
+            for i in range(max(self.nodes // 4, 1)):
+                digest = hashlib.md5(('%s:%s' % tuple(channel.addr[:2]) + str(i)).encode()).digest()
+                for h in range(4):
+                    ring.append((_hash(digest, h), channel))
+        ring.sort(key=lambda node: node[0])
+        self.hashes = [node[0] for node in ring]
+        self.channels = [node[1] for node in ring]
+
+
+LOADBALANCES = {
+    'random': RandomLoadBalance,
+    'roundrobin': RoundRobinLoadBalance,
+    'leastactive': LeastActiveLoadBalance,
+    'peakewma': PeakEwmaLoadBalance,
+    'consistenthash': ConsistentHashLoadBalance,
+}
+
+
+def registerLoadBalance(name, cls):
+    LOADBALANCES[name] = cls
+
+
+def createLoadBalance(name):
+    if isinstance(name, LoadBalance):
+        return name
+    if name not in LOADBALANCES:
+        raise KeyError('unknown loadbalance ' + str(name))
+    return LOADBALANCES[name]()
+
+
+def _weightedChoice(channels):
+    if len(channels) == 1:
+        return channels[0]
+    weights = [channel.weight for channel in channels]
+    if min(weights) == max(weights):
+        return random.choice(channels)
+    return random.choices(channels, weights)[0]
+
+
+def _hash(digest, index):
+    return struct.unpack_from('<I', digest, index * 4)[0]
+
+
+def _hashKey(value):
+    if isinstance(value, _model.Object):
+        return value._metaType + str(sorted((k, _hashKey(v)) for k, v in value.__dict__.items() if k != '_metaType'))
+    return str(value)
@@ -1,14 +1,23 @@
 
+import os
 import threading
 import struct
 from . import hessian2
+from . import java
+from . import _model
+from .serialization import getSerialization, getSerializationById
+from .constants import CLIENT_ATTACHMENT_KEYS, TEMPLATE_CACHE_SIZE, KEY_SERIALIZATION, DEFAULT_PAYLOAD
 
 HEADER_LENGTH = 16
+# magic, flag, status, request id, body length
+HEADER = struct.Struct('>2sBBqi')
 MAGIC_NUMBER = b'\xda\xbb'
 FLAG_REQUEST = 0x80
 FLAG_TWOWAY = 0x40
 FLAG_EVENT = 0x20
 HESSIAN2_CONTENT_TYPE_ID = 2
+# the serialization id in the low bits of the flag
+SERIALIZATION_MASK = 0x1f
 
 DOUBLE_VERSION = '2.3.3'
 
@@ -16,6 +25,9 @@ RESPONSE_NULL_VALUE = 2
 RESPONSE_VALUE = 1
 RESPONSE_WITH_EXCEPTION = 0
 
+GENERIC_METHOD_NAME = '$invoke'
+GENERIC_PARAMETER_TYPES = 'Ljava/lang/String;[Ljava/lang/String;[Ljava/lang/Object;'
+
 class RpcInvocation(object) :
     def __init__(self, methodName = None, paramTypes = None, params = None, attachments = None) :
         self.methodName = methodName
@@ -23,6 +35,22 @@ class RpcInvocation(object) :
         self.params = params or []
         self.attachments = attachments or {}
 
+    def getMethodName(self):
+        '''
+            name of the service method, also for a generic $invoke
+        '''
+        if self.methodName == GENERIC_METHOD_NAME and self.params:
+            return self.params[0]
+        return self.methodName
+
+    def getArguments(self):
+        '''
+            arguments of the service method, also for a generic $invoke
+        '''
+        if self.methodName == GENERIC_METHOD_NAME and len(self.params) == 3:
+            return self.params[2] or []
+        return self.params
+
 class RpcResult(object) :
     def __init__(self, value = None, exception = None) :
         self.value = value
@@ -46,10 +74,21 @@ class DubboRequest(object) :
         self.isBroken = broken
         self.data = data
         self.isHeartbeat = False
+        # name or Serialization, None for the serialization attachment or hessian2
+        self.serialization = None
 
     def __str__(self) :
         return 'DubboRequest :' + str(self.__dict__)
 
+    @classmethod
+    def resetRid(cls):
+        # the lock may have been held by another thread at fork time
+        cls.ridLock = threading.Lock()
+        cls.nextRid = 0
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=DubboRequest.resetRid)
+
 class DubboResponse(object) :
     OK = 20
     CLIENT_TIMEOUT = 30
@@ -70,6 +109,7 @@ class DubboResponse(object) :
         self.errorMsg = ''
         self.result = None
         self.exception = None
+        self.serialization = None
 
     def isHeartBeat(self):
         return self.event and self.result == None
@@ -97,98 +137,219 @@ class DubboTimeoutException(Exception):
         self.data = data
 
     def __str__(self):
-        return 'DubboTimeoutException :', self.data
-
-def encodeRequestData(invocation) :
-    out = hessian2.Hessian2Output()
-    out.writeObject(DOUBLE_VERSION)
-    out.writeObject(invocation.attachments['path'])
-    out.writeObject(invocation.attachments['version'])
-    out.writeObject(invocation.methodName)
-    out.writeObject(invocation.paramTypes)
+        return 'DubboTimeoutException :' + str(self.data)
+
+class DubboRejectedException(Exception):
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return 'DubboRejectedException :' + str(self.data)
+
+class DubboStatusException(Exception):
+    '''
+        the provider answered with a status other than OK
+    '''
+    def __init__(self, status, data):
+        self.status = status
+        self.data = data
+
+    def __str__(self):
+        return 'DubboStatusException :' + str(self.status) + ' ' + str(self.data)
+
+# encoded request parts that repeat call after call, spliced in as bytes
+_requestPrefixes = {}
+_attachmentSuffixes = {}
+# values whose encoding never refers back to earlier objects of the stream
+_SIMPLE_TYPES = (str, bytes, int, float, bool, type(None))
+
+def _requestPrefix(serialization, path, version, methodName, paramTypes):
+    key = (serialization.contentTypeId, path, version, methodName, paramTypes)
+    prefix = _requestPrefixes.get(key)
+    if prefix is None:
+        out = serialization.getOutput()
+        out.writeObject(DOUBLE_VERSION)
+        out.writeObject(path)
+        out.writeObject(version)
+        out.writeObject(methodName)
+        out.writeObject(paramTypes)
+        prefix = out.getByteString()
+        if len(_requestPrefixes) >= TEMPLATE_CACHE_SIZE:
+            _requestPrefixes.clear()
+        _requestPrefixes[key] = prefix
+    return prefix
+
+def writeRequestData(out, invocation, serialization=None):
+    serialization = getSerialization(serialization)
+    attachments = invocation.attachments
+    prefix = _requestPrefix(serialization, attachments['path'], attachments['version'],
+                            invocation.methodName, invocation.paramTypes)
+    # the prefix has strings only, they are never referenced, so spliced
+    # bytes encode the same as objects written one by one
+    out.writeRaw(prefix)
     for param in invocation.params:
-        #oo = hessian2.Hessian2Output()
-        #oo.writeObject(param)
-        #hessian2.printByteStr(oo.getByteString())
         out.writeObject(param)
-    out.writeObject(invocation.attachments)
+    # 1, 1.0 and True are equal keys but encode differently, the type is part of the key
+    items = (serialization.contentTypeId,) + tuple((k, v, type(v)) for k, v in attachments.items()
+                                                   if k not in CLIENT_ATTACHMENT_KEYS)
+    try:
+        suffix = _attachmentSuffixes.get(items)
+    except TypeError:
+        suffix = None
+    if suffix is None:
+        filtered = dict((k, v) for k, v, t in items[1:])
+        if not all(t in _SIMPLE_TYPES for k, v, t in items[1:]):
+            out.writeObject(filtered)
+            return
+        suffixOut = serialization.getOutput()
+        suffixOut.writeObject(filtered)
+        suffix = suffixOut.getByteString()
+        if len(_attachmentSuffixes) >= TEMPLATE_CACHE_SIZE:
+            _attachmentSuffixes.clear()
+        _attachmentSuffixes[items] = suffix
+    out.writeRaw(suffix)
+
+
+def encodeRequestData(invocation, serialization=None) :
+    out = getSerialization(serialization).getOutput()
+    writeRequestData(out, invocation, serialization)
     return out.getByteString()
 
 
-def encodeEventData(data):
-    out = hessian2.Hessian2Output()
+def encodeEventData(data, serialization=None):
+    out = getSerialization(serialization).getOutput()
     out.writeObject(data)
     return out.getByteString()
 
 
+def encodeFrame(flag, status, rid, body):
+    # one Struct packs the header, concatenating beats patching a reserved header
+    # into the output for the usual frame of a few hundred bytes
+    return HEADER.pack(MAGIC_NUMBER, flag, status, rid, len(body)) + body
+
+
 def encodeRequest(request):
     if not isinstance(request, DubboRequest) :
         raise TypeError('encodeRequest only support DubboRequest type')
-    header = b''
-    header += MAGIC_NUMBER
-    flag = HESSIAN2_CONTENT_TYPE_ID | FLAG_REQUEST
+    serialization = request.serialization
+    if serialization is None and not request.isEvent:
+        serialization = request.data.attachments.get(KEY_SERIALIZATION)
+    serialization = getSerialization(serialization)
+    flag = serialization.contentTypeId | FLAG_REQUEST
     if request.isEvent:
         flag |= FLAG_EVENT
     if request.isTwoWay:
         flag |= FLAG_TWOWAY
 
-    header += flag.to_bytes(1, 'big')
-    header += b'\x00'
-    header += struct.pack('>q', request.rid)
-
+    out = serialization.getOutput()
     if request.isEvent:
-        pass
-        data = encodeEventData(request.data)
+        out.writeObject(request.data)
     else :
-        data = encodeRequestData(request.data)
+        writeRequestData(out, request.data, serialization)
+    return encodeFrame(flag, 0, request.rid, out.getByteString())
 
-    dataLength = len(data)
-    header += struct.pack('>i', dataLength)
 
-    return header + data
+def writeResponseData(out, rpcResult):
+    if rpcResult.exception is not None:
+        out.writeObject(RESPONSE_WITH_EXCEPTION)
+        out.writeObject(rpcResult.exception)
+    elif rpcResult.value is None:
+        out.writeObject(RESPONSE_NULL_VALUE)
+    else:
+        out.writeObject(RESPONSE_VALUE)
+        out.writeObject(rpcResult.value)
 
 
-def encodeResponseData(rpcResult):
-    if rpcResult.exception:
-        out.write(RESPONSE_WITH_EXCEPTION)
-        out.write(rpcResult.value)
-    elif rpcResult.value == None:
-        out.write(RESPONSE_NULL_VALUE)
-    else:
-        out.write(RESPONSE_VALUE)
-        out.write(rpcResult.value)
+def encodeResponseData(rpcResult, serialization=None):
+    out = getSerialization(serialization).getOutput()
+    writeResponseData(out, rpcResult)
+    return out.getByteString()
 
 
 def encodeResponse(response):
     if not isinstance(response, DubboResponse):
         raise TypeError('encodeResponse only support DubboResponse type')
-    header = b''
-    header += MAGIC_NUMBER
-    flag = HESSIAN2_CONTENT_TYPE_ID
+    serialization = getSerialization(response.serialization)
+    flag = serialization.contentTypeId
     if response.isEvent:
         flag |= FLAG_EVENT
-    header += flag.to_bytes(1, 'big')
-    header += response.status.to_bytes(1, 'big')
-    header += struct.pack('>q', response.rid)
 
-    if response.status == DubboResponse.OK:
-        if response.isEvent:
-            data = encodeEventData(response.result)
-        else:
-            data = encodeResponseData(response.result)
+    out = serialization.getOutput()
+    if response.status != DubboResponse.OK:
+        out.writeObject(response.errorMsg)
+    elif response.isEvent:
+        out.writeObject(response.result)
+    else:
+        writeResponseData(out, response.result)
+    return encodeFrame(flag, response.status, response.rid, out.getByteString())
 
-    dataLength = len(data)
-    header += struct.pack('>i', dataLength)
 
-    return header + data
+def decodeHeader(header, offset=0):
+    '''
+        (magic, flag, status, rid, dataLength) of the header at offset
+    '''
+    return HEADER.unpack_from(header, offset)
 
 
 def getDataLength(header):
-    return struct.unpack('>i', header[12:])[0]
+    return HEADER.unpack_from(header)[4]
 
 
 def getRequestId(header):
-    return struct.unpack('>q', header[4:12])[0]
+    return HEADER.unpack_from(header)[3]
+
+
+class FrameDecoder(object):
+    '''
+        incremental splitter of a byte stream into dubbo frames, it does no IO.
+        feed() the received chunks, then iterate frames() for the complete ones.
+        a body length below 0 or above payload raises ValueError, the stream
+        cannot be split any further and its connection has to be closed
+    '''
+    def __init__(self, payload=DEFAULT_PAYLOAD):
+        self.buffer = bytearray()
+        self.offset = 0
+        self.payload = payload
+
+    def feed(self, data):
+        self.buffer += data
+
+    def frames(self):
+        '''
+            yield (header, body) of the buffered complete frames, header is the
+            tuple of decodeHeader() and body a memoryview only valid until the next feed()
+        '''
+        buffer = self.buffer
+        view = memoryview(buffer)
+        try:
+            while len(buffer) - self.offset >= HEADER_LENGTH:
+                offset = self.offset
+                header = HEADER.unpack_from(buffer, offset)
+                if header[0] != MAGIC_NUMBER:
+                    # skip garbage up to the next magic number only
+                    index = buffer.find(MAGIC_NUMBER, offset + 1)
+                    self.offset = index if index != -1 else len(buffer) - 1
+                    continue
+                if header[4] < 0 or header[4] > self.payload:
+                    raise ValueError('bad body length %d of request %d' % (header[4], header[3]))
+                end = offset + HEADER_LENGTH + header[4]
+                if len(buffer) < end:
+                    break
+                self.offset = end
+                yield header, view[offset + HEADER_LENGTH:end]
+        finally:
+            del view
+            self.__compact()
+
+    def __compact(self):
+        if not self.offset:
+            return
+        try:
+            del self.buffer[:self.offset]
+        except BufferError:
+            # a frame view is still held by the caller, leave it valid
+            self.buffer = self.buffer[self.offset:]
+        self.offset = 0
 
 
 def decodeResponseData(response, input):
@@ -199,18 +360,35 @@ def decodeResponseData(response, input):
         response.result = input.readObject()
     elif flag == RESPONSE_WITH_EXCEPTION:
         response.exception = input.readObject()
+        if isinstance(response.exception, dict):
+            # serializations without class names give the throwable as a map
+            response.exception = _model.Object('java.lang.Throwable', response.exception)
 
 
 def decodeRequestData(request, input):
-    return None
+    dubboVersion = input.readObject()
+    path = input.readObject()
+    version = input.readObject()
+    methodName = input.readObject()
+    paramTypes = input.readObject()
+    # the descriptor tells how many arguments follow
+    params = [input.readObject() for t in java.analyseParamTypes(paramTypes or '')]
+    attachments = input.readObject() or {}
+    attachments['path'] = path
+    attachments['version'] = version
+    attachments.setdefault('dubbo', dubboVersion)
+    request.data = RpcInvocation(methodName, paramTypes, params, attachments)
 
 def decode(header, data):
-    flag = header[2]
-    status = header[3]
-    rid = getRequestId(header)
-    input = hessian2.Hessian2Input(data)
+    if not isinstance(header, tuple):
+        header = HEADER.unpack_from(header)
+    magic, flag, status, rid, dataLength = header
+    serialization = getSerializationById(flag & SERIALIZATION_MASK)
+    input = serialization.getInput(data)
     if flag & FLAG_REQUEST != 0:
         request = DubboRequest(rid=rid)
+        # answered in the serialization it was sent with
+        request.serialization = serialization
         request.isTwoWay = flag & FLAG_TWOWAY != 0
         if flag & FLAG_EVENT != 0:
             request.isEvent = True
@@ -222,6 +400,7 @@ def decode(header, data):
         return request
     else:
         response = DubboResponse(rid)
+        response.serialization = serialization
         response.status = status
         response.isEvent = flag & FLAG_EVENT
         if response.status != DubboResponse.OK:
@@ -0,0 +1,136 @@
+import base64
+import datetime
+import json
+import time
+from io import BytesIO
+
+from . import hessian2
+from ._model import Object, Binary
+
+
+class Serialization(object):
+    '''
+        codec of the bodies of dubbo frames. contentTypeId is the id sent in the
+        flag byte of the header, it tells the other side how to decode the body
+    '''
+    name = None
+    contentTypeId = None
+
+    def getOutput(self):
+        '''
+            an output with writeObject(value), writeRaw(bytes) and getByteString()
+        '''
+        raise NotImplementedError
+
+    def getInput(self, data):
+        '''
+            an input with readObject()
+        '''
+        raise NotImplementedError
+
+
+class Hessian2Serialization(Serialization):
+    name = 'hessian2'
+    contentTypeId = 2
+
+    def __init__(self, debug=False):
+        # registerSerialization(Hessian2Serialization(debug=True)) prints every value decoded
+        self.inputClass = hessian2.DebugHessian2Input if debug else hessian2.Hessian2Input
+
+    def getOutput(self):
+        return hessian2.Hessian2Output()
+
+    def getInput(self, data):
+        return self.inputClass(data)
+
+
+def _toJson(value):
+    if isinstance(value, Object):
+        return dict((k, v) for k, v in value.__dict__.items() if k != '_metaType')
+    if isinstance(value, Binary):
+        return base64.b64encode(value.value or b'').decode('ascii')
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    if isinstance(value, datetime.datetime):
+        return int(value.timestamp() * 1000)
+    if isinstance(value, time.struct_time):
+        return int(time.mktime(value) * 1000)
+    raise TypeError('%s is not JSON serializable' % type(value).__name__)
+
+
+class JsonOutput(object):
+    '''
+        one JSON document per line, as FastJsonObjectOutput of dubbo writes them
+    '''
+    def __init__(self):
+        self.output = BytesIO()
+        self.encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=_toJson)
+
+    def writeObject(self, value):
+        self.output.write(self.encoder.encode(value).encode('utf-8'))
+        self.output.write(b'\n')
+
+    def writeRaw(self, value):
+        self.output.write(value)
+
+    def getByteString(self):
+        return self.output.getvalue()
+
+
+class JsonInput(object):
+    def __init__(self, data):
+        self.input = BytesIO(data)
+
+    def readObject(self):
+        line = self.input.readline()
+        if not line:
+            raise ValueError('End Of Byte String')
+        return json.loads(line)
+
+
+class FastjsonSerialization(Serialization):
+    '''
+        the fastjson serialization of dubbo. java objects travel as plain JSON
+        objects, they come back as dicts and the provider maps them by the parameter types
+    '''
+    name = 'fastjson'
+    contentTypeId = 6
+
+    def getOutput(self):
+        return JsonOutput()
+
+    def getInput(self, data):
+        return JsonInput(data)
+
+
+# name -> Serialization, content type id -> Serialization
+SERIALIZATIONS = {}
+CONTENT_TYPES = {}
+
+
+def registerSerialization(serialization):
+    SERIALIZATIONS[serialization.name] = serialization
+    CONTENT_TYPES[serialization.contentTypeId] = serialization
+
+
+def getSerialization(name):
+    if name is None:
+        return DEFAULT_SERIALIZATION
+    if isinstance(name, Serialization):
+        return name
+    if name not in SERIALIZATIONS:
+        raise KeyError('unknown serialization ' + str(name))
+    return SERIALIZATIONS[name]
+
+
+def getSerializationById(contentTypeId):
+    if contentTypeId not in CONTENT_TYPES:
+        raise ValueError('unknown serialization id %s' % contentTypeId)
+    return CONTENT_TYPES[contentTypeId]
+
+
+DEFAULT_SERIALIZATION = Hessian2Serialization()
+registerSerialization(DEFAULT_SERIALIZATION)
+registerSerialization(FastjsonSerialization())
@@ -0,0 +1,322 @@
+import asyncio
+import concurrent.futures
+
+from . import protocol
+from ._model import Object
+from .serialization import getSerializationById
+from .constants import *
+
+
+def _javaException(e):
+    # a Throwable as java consumers deserialize it, the python type goes in the message
+    if isinstance(e, protocol.DubboException):
+        return e.data
+    return Object('java.lang.RuntimeException', {
+        'detailMessage': '%s: %s' % (type(e).__name__, e),
+        'stackTrace': [],
+    })
+
+
+class Service(object):
+    '''
+        a registered handler object, its public methods are the methods of the service.
+        coroutine methods run on the event loop, the others on the thread pool of the server
+    '''
+    def __init__(self, interface, handler, version=DEFAULT_SERVICE_VERSION):
+        self.interface = interface
+        self.handler = handler
+        self.version = version
+        # name -> (function, is coroutine function)
+        self.methods = {}
+
+    def getMethod(self, name):
+        method = self.methods.get(name)
+        if method is None:
+            if not name or name.startswith('_'):
+                return None
+            func = getattr(self.handler, name, None)
+            if not callable(func):
+                return None
+            method = self.methods[name] = (func, asyncio.iscoroutinefunction(func))
+        return method
+
+
+class ServerConnection(asyncio.Protocol):
+    '''
+        one consumer connection. requests are dispatched as soon as their frame is
+        complete, responses are written in the order the calls finish
+    '''
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.decoder = protocol.FrameDecoder()
+        self.active = 0
+        self.paused = False
+        self.outgoing = []
+        self.outgoingBytes = 0
+        self.flushHandle = None
+        self.idle = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.connections.add(self)
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self.server.connections.discard(self)
+        if self.flushHandle is not None:
+            self.flushHandle.cancel()
+            self.flushHandle = None
+        if self.idle is not None and not self.idle.done():
+            self.idle.set_result(None)
+
+    def data_received(self, data):
+        self.decoder.feed(data)
+        try:
+            self.__received()
+        except ValueError as e:
+            print('Bad frame from %s, close connection: %s' % (self.__peer(), e))
+            self.close()
+
+    def __received(self):
+        for header, body in self.decoder.frames():
+            try:
+                request = protocol.decode(header, body)
+            except Exception as e:
+                print('Bad request %s from %s: %s' % (header[3], self.__peer(), e))
+                response = protocol.DubboResponse(header[3])
+                response.serialization = self.__serialization(header[1])
+                response.status = protocol.DubboResponse.BAD_REQUEST
+                response.errorMsg = 'decode request failed: %s' % e
+                self.write(protocol.encodeResponse(response))
+                continue
+            if not isinstance(request, protocol.DubboRequest):
+                # the answer to a heartbeat we never send
+                continue
+            if request.isEvent:
+                if request.isTwoWay:
+                    response = protocol.DubboResponse(request.rid)
+                    response.serialization = request.serialization
+                    response.isEvent = True
+                    self.write(protocol.encodeResponse(response))
+                continue
+            self.server.dispatch(self, request)
+
+    def begin(self):
+        self.active += 1
+        if self.server.maxRequests and self.active >= self.server.maxRequests and not self.paused:
+            # pipelined requests wait in the socket buffer until calls finish
+            self.paused = True
+            self.transport.pause_reading()
+
+    def end(self):
+        self.active -= 1
+        if self.paused and self.active < self.server.maxRequests and self.transport is not None:
+            self.paused = False
+            self.transport.resume_reading()
+        if self.active <= 0 and self.idle is not None and not self.idle.done():
+            self.idle.set_result(None)
+
+    def respond(self, request, value=None, exception=None, status=protocol.DubboResponse.OK, errorMsg=''):
+        if not request.isTwoWay or self.transport is None:
+            return
+        response = protocol.DubboResponse(request.rid)
+        response.serialization = request.serialization
+        response.status = status
+        response.errorMsg = errorMsg
+        response.result = protocol.RpcResult(value, exception)
+        try:
+            data = protocol.encodeResponse(response)
+        except Exception as e:
+            print('Encode response of %s failed: %s' % (request.data.methodName, e))
+            response.status = protocol.DubboResponse.BAD_RESPONSE
+            response.errorMsg = 'encode response failed: %s' % e
+            data = protocol.encodeResponse(response)
+        self.write(data)
+
+    def write(self, data):
+        self.outgoing.append(data)
+        self.outgoingBytes += len(data)
+        if self.outgoingBytes >= self.server.flushBytes:
+            self.flush()
+        elif self.flushHandle is None:
+            loop = asyncio.get_running_loop()
+            if self.server.flushDelay:
+                self.flushHandle = loop.call_later(self.server.flushDelay, self.flush)
+            else:
+                self.flushHandle = loop.call_soon(self.flush)
+
+    def flush(self):
+        if self.flushHandle is not None:
+            self.flushHandle.cancel()
+            self.flushHandle = None
+        outgoing, self.outgoing = self.outgoing, []
+        self.outgoingBytes = 0
+        if outgoing and self.transport is not None and not self.transport.is_closing():
+            self.transport.writelines(outgoing)
+
+    async def drain(self):
+        '''
+            waits for the calls in progress to be answered
+        '''
+        if self.active > 0 and self.transport is not None:
+            self.idle = asyncio.get_running_loop().create_future()
+            await self.idle
+        self.flush()
+
+    def close(self):
+        self.flush()
+        if self.transport is not None:
+            self.transport.close()
+
+    def __serialization(self, flag):
+        try:
+            return getSerializationById(flag & protocol.SERIALIZATION_MASK)
+        except ValueError:
+            return None
+
+    def __peer(self):
+        return self.transport.get_extra_info('peername') if self.transport else None
+
+
+class DubboServer(object):
+    '''
+        provider of python services to dubbo consumers, java or python.
+        each connection carries any number of concurrent requests
+    '''
+    def __init__(self, addr, config=None):
+        self.addr = tuple(addr[:2])
+        config = config or {}
+        # blocking methods run on this many threads, 0 runs them on the event loop
+        self.threads = config.get(KEY_THREADS, DEFAULT_SERVER_THREADS)
+        # requests in progress per connection before reading from it stops, 0 is unbounded
+        self.maxRequests = config.get(KEY_MAX_REQUESTS, DEFAULT_SERVER_MAX_REQUESTS)
+        self.flushBytes = config.get(KEY_FLUSH_BYTES, DEFAULT_FLUSH_BYTES)
+        self.flushDelay = config.get(KEY_FLUSH_DELAY, DEFAULT_FLUSH_DELAY)
+        # (interface, version) -> Service
+        self.services = {}
+        self.connections = set()
+        self.executor = None
+        self.server = None
+
+        self.requests = 0
+        self.errors = 0
+
+    def register(self, interface, handler, version=DEFAULT_SERVICE_VERSION):
+        service = Service(interface, handler, version)
+        self.services[(interface, version)] = service
+        return service
+
+    def unregister(self, interface, version=DEFAULT_SERVICE_VERSION):
+        return self.services.pop((interface, version), None)
+
+    async def start(self):
+        if self.threads and self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.threads, thread_name_prefix='dubbo-server')
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(lambda: ServerConnection(self), self.addr[0], self.addr[1])
+        print('Dubbo server listen on %s:%s' % self.addr)
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+        await self.server.serve_forever()
+
+    def dispatch(self, connection, request):
+        invocation = request.data
+        attachments = invocation.attachments
+        self.requests += 1
+        service = self.services.get((attachments['path'], attachments['version']))
+        if service is None:
+            self.errors += 1
+            connection.respond(request, status=protocol.DubboResponse.SERVICE_NOT_FOUND,
+                               errorMsg='service %s:%s not found' % (attachments['path'], attachments['version']))
+            return
+
+        name, args = invocation.methodName, invocation.params
+        if name == protocol.GENERIC_METHOD_NAME and len(args) == 3:
+            name, args = args[0], args[2] or []
+        method = service.getMethod(name)
+        if method is None:
+            self.errors += 1
+            connection.respond(request, status=protocol.DubboResponse.SERVICE_ERROR,
+                               errorMsg='method %s not found in service %s' % (name, service.interface))
+            return
+
+        func, isCoroutine = method
+        connection.begin()
+        if isCoroutine:
+            asyncio.ensure_future(self.__await(connection, request, func, args))
+        elif self.executor is not None:
+            future = asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+            future.add_done_callback(lambda f: self.__done(connection, request, f))
+        else:
+            try:
+                value = func(*args)
+            except Exception as e:
+                self.__failed(connection, request, e)
+            else:
+                connection.respond(request, value)
+            connection.end()
+
+    async def __await(self, connection, request, func, args):
+        try:
+            value = await func(*args)
+        except asyncio.CancelledError:
+            connection.respond(request, status=protocol.DubboResponse.SERVER_ERROR, errorMsg='server closed')
+            raise
+        except Exception as e:
+            self.__failed(connection, request, e)
+        else:
+            connection.respond(request, value)
+        finally:
+            connection.end()
+
+    def __done(self, connection, request, future):
+        try:
+            if future.cancelled():
+                connection.respond(request, status=protocol.DubboResponse.SERVER_ERROR, errorMsg='server closed')
+            elif future.exception() is not None:
+                self.__failed(connection, request, future.exception())
+            else:
+                connection.respond(request, future.result())
+        finally:
+            connection.end()
+
+    def __failed(self, connection, request, e):
+        self.errors += 1
+        connection.respond(request, exception=_javaException(e))
+
+    def stats(self):
+        return {
+            'connections': len(self.connections),
+            'active': sum(connection.active for connection in self.connections),
+            'requests': self.requests,
+            'errors': self.errors,
+            'services': ['%s:%s' % key for key in self.services],
+        }
+
+    async def close(self, timeout=DEFAULT_CLOSE_TIMEOUT):
+        '''
+            stops accepting connections and waits up to timeout seconds for the
+            calls in progress, returns whether they all finished
+        '''
+        if self.server is not None:
+            self.server.close()
+        connections = list(self.connections)
+        drained = True
+        if connections:
+            done, pending = await asyncio.wait([asyncio.ensure_future(c.drain()) for c in connections],
+                                               timeout=timeout)
+            for future in pending:
+                future.cancel()
+            drained = not pending
+        for connection in connections:
+            connection.close()
+        if self.server is not None:
+            await self.server.wait_closed()
+            self.server = None
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        return drained
@@ -0,0 +1,202 @@
+import asyncio
+import concurrent.futures
+import os
+import threading
+import weakref
+
+from .constants import *
+from .dubbo import Dubbo
+
+
+# every SyncDubbo of the process, its loop thread is started again in the child after a fork
+_clients = weakref.WeakSet()
+
+
+def _afterFork():
+    for client in list(_clients):
+        client.afterFork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_afterFork)
+
+
+class EventLoopThread(object):
+    '''
+        an event loop running forever on a daemon thread. coroutines are
+        submitted from any other thread and waited for with concurrent.futures
+    '''
+    def __init__(self, name='dubbo-loop'):
+        self.name = name
+        self.lock = threading.Lock()
+        self.loop = None
+        self.thread = None
+        # loops copied from the parent process by a fork, never to be closed or run
+        self.inherited = []
+        self.__start()
+
+    def afterFork(self):
+        # the thread did not survive the fork, the next call starts a new one
+        self.lock = threading.Lock()
+        if self.loop is not None:
+            self.inherited.append(self.loop)
+        self.loop = None
+        self.thread = None
+
+    def submit(self, coroutine):
+        self.__checkThread()
+        return asyncio.run_coroutine_threadsafe(coroutine, self.__running())
+
+    def call(self, coroutine):
+        return self.submit(coroutine).result()
+
+    def run(self, func, *args):
+        '''
+            call func on the loop thread and return its result
+        '''
+        self.__checkThread()
+        future = concurrent.futures.Future()
+
+        def wrapper():
+            try:
+                future.set_result(func(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+        self.__running().call_soon_threadsafe(wrapper)
+        return future.result()
+
+    def stop(self):
+        if self.loop is not None and not self.loop.is_closed():
+            self.call(self.__cancelTasks())
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+
+    def __checkThread(self):
+        # blocking on the loop from its own thread would never return
+        if threading.current_thread() is self.thread:
+            raise RuntimeError('a blocking dubbo call can not be made on the dubbo event loop thread')
+
+    async def __cancelTasks(self):
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def __running(self):
+        if self.loop is None:
+            with self.lock:
+                if self.loop is None:
+                    self.__start()
+        return self.loop
+
+    def __start(self):
+        loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.__run, args=(loop,), name=self.name, daemon=True)
+        started = threading.Event()
+        loop.call_soon(started.set)
+        self.thread.start()
+        started.wait()
+        self.loop = loop
+
+    def __run(self, loop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+
+
+class SyncServiceProxy(object):
+    '''
+        blocking view of a ServiceProxy, calls run on the loop thread of the SyncDubbo
+    '''
+    def __init__(self, runner, proxy):
+        # the runner outlives forks, its loop is replaced in the child
+        self.runner = runner
+        self.proxy = proxy
+
+    def __enter__(self):
+        self.proxy.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.proxy.__exit__(exc_type, exc_val, exc_tb)
+
+    def invoke(self, name, args):
+        return self.runner.call(self.proxy.invoke(name, args))
+
+    def submit(self, name, args):
+        '''
+            returns a concurrent.futures.Future of the call instead of blocking
+        '''
+        return self.runner.submit(self.proxy.invoke(name, args))
+
+    def invoke_many(self, name, argsIterable, **kwargs):
+        '''
+            returns the list of InvokeResult of ServiceProxy.invoke_many
+        '''
+        async def collect():
+            return [result async for result in self.proxy.invoke_many(name, argsIterable, **kwargs)]
+
+        return self.runner.call(collect())
+
+    def __getattr__(self, name):
+        def dubbo_invoke(*args):
+            return self.invoke(name, args)
+
+        return dubbo_invoke
+
+
+class SyncDubbo(object):
+    '''
+        Dubbo for blocking code. one event loop on a daemon thread owns the
+        connections, calls from any thread are multiplexed over them
+    '''
+    def __init__(self, addrs, config=None, enable_heartbeat=False):
+        self.runner = EventLoopThread()
+        self.dubbo = Dubbo(addrs, config, enable_heartbeat)
+        self.warmupOnStart = config.get(KEY_WARMUP, False) if config else False
+        if self.warmupOnStart:
+            self.warmup()
+        _clients.add(self)
+
+    def afterFork(self):
+        self.runner.afterFork()
+        if self.warmupOnStart:
+            # connect in the background, the first call of the worker waits for it if needed
+            self.runner.submit(self.dubbo.warmup())
+
+    def warmup(self):
+        '''
+            opens the connections to every provider now, on the loop thread
+        '''
+        return self.runner.call(self.dubbo.warmup())
+
+    def getObject(self, name):
+        return self.dubbo.getObject(name)
+
+    def getProxy(self, interface, **args):
+        proxy = self.dubbo.getProxy(interface, **args)
+        if proxy is None:
+            return None
+        return SyncServiceProxy(self.runner, proxy)
+
+    def createConstObjectFromClass(self, className):
+        return self.dubbo.createConstObjectFromClass(className)
+
+    def stats(self):
+        return self.runner.run(self.dubbo.stats)
+
+    def clusterStats(self):
+        return self.runner.run(self.dubbo.clusterStats)
+
+    def cacheStats(self):
+        return self.runner.run(self.dubbo.cacheStats)
+
+    def batchStats(self):
+        return self.runner.run(self.dubbo.batchStats)
+
+    def close(self, timeout=DEFAULT_CLOSE_TIMEOUT):
+        try:
+            return self.runner.call(self.dubbo.close(timeout))
+        finally:
+            self.runner.stop()